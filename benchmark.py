@@ -0,0 +1,273 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+import instrumentation
+import nli
+import preprocessing
+import synthetic_twcs
+from cache_store import NLICache, SpellingCache
+from cross_validation import cross_validate_nli_template
+from event_log_construction import to_event_log
+from stage_io import list_stage_files, read_stage
+from xes_io import import_xes, write_xes
+
+entry_points = ['preprocessing', 'nli', 'cross_validation', 'keyword_classification', 'event_log_construction',
+                'process_mining', 'pipeline']
+
+
+def remove_non_english_tweets_rowwise(df):
+    model = preprocessing.model.get()
+    return df[df.apply(lambda x: model.predict(str(x['text']).replace('\n', ''))[0][0] == '__label__en', axis=1)]
+
+
+def correct_spellings_inbound_rowwise(df):
+    df['text'] = df.apply(lambda x: preprocessing.correct_spellings(x['text']) if x['inbound'] == True else x['text'],
+                          axis=1)
+    return df
+
+
+def correct_spellings_inbound_uncached(df, jobs):
+    with SpellingCache(':memory:', 'benchmark') as spelling_cache:
+        return preprocessing.correct_spellings_inbound(df, spelling_cache, jobs=jobs)
+
+
+def load_preprocessed_tweets(scale):
+    path = os.path.join('data', 'preprocessed')
+    df = pd.concat([read_stage(os.path.join(path, filename), index_col=[0]) for filename in list_stage_files(path)],
+                   ignore_index=True)
+    return pd.concat([df] * scale, ignore_index=True)
+
+
+def measure(function, *args, repeat=3, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def benchmark_remove_non_english_tweets(df, repeat, jobs):
+    rowwise_time, df_rowwise = measure(remove_non_english_tweets_rowwise, df, repeat=repeat)
+    batched_time, df_batched = measure(preprocessing.remove_non_english_tweets, df, repeat=repeat, jobs=jobs)
+    assert df_rowwise.equals(df_batched)
+    print('remove_non_english_tweets on {} Tweets: row-wise {:.3f}s, batched {:.3f}s ({:.1f}x)'.format(
+        len(df.index), rowwise_time, batched_time, rowwise_time / batched_time))
+
+
+def benchmark_correct_spellings_inbound(df, repeat, jobs):
+    rowwise_time, df_rowwise = measure(lambda: correct_spellings_inbound_rowwise(df.copy()), repeat=repeat)
+    batched_time, df_batched = measure(lambda: correct_spellings_inbound_uncached(df.copy(), jobs), repeat=repeat)
+    assert df_rowwise.equals(df_batched)
+    print('correct_spellings_inbound on {} Tweets: row-wise {:.3f}s, batched {:.3f}s ({:.1f}x)'.format(
+        len(df.index), rowwise_time, batched_time, rowwise_time / batched_time))
+
+
+def measure_startup(statement, repeat):
+    # Wall time of a fresh interpreter running the statement, e.g. importing a script's module before it does any work
+    startup_time, _ = measure(subprocess.run, [sys.executable, '-c', statement], check=True,
+                              stderr=subprocess.PIPE, repeat=repeat)
+    return startup_time
+
+
+def benchmark_startup(repeat):
+    interpreter_time = measure_startup('pass', repeat)
+    print('Python interpreter startup: {:.3f}s'.format(interpreter_time))
+    results = [{'name': 'python', 'unit': 'startup', 'items': 1, 'seconds': interpreter_time}]
+    for module in entry_points:
+        name = 'import ' + module
+        try:
+            import_time = measure_startup(name, repeat)
+        except subprocess.CalledProcessError as error:
+            # E.g. a missing dependency, which is reported with the last line of its traceback like a failed stage
+            message = error.stderr.decode('utf-8', 'replace').strip().splitlines()[-1:]
+            print('{}: failed with {}'.format(name, ''.join(message)))
+            results.append({'name': name, 'unit': 'startup', 'items': 1, 'error': ''.join(message)})
+            continue
+        print('{}: {:.3f}s ({:.3f}s above the interpreter)'.format(name, import_time, import_time - interpreter_time))
+        results.append({'name': name, 'unit': 'startup', 'items': 1, 'seconds': import_time})
+    return results
+
+
+def stub_entailment_scores(pairs, hypothesis_template="{}.", batch_size=32):
+    # Stands in for the NLI model with a score derived from a hash of the premise and the hypothesis, so that the
+    # benchmarks measure everything around the model and need neither the model nor torch
+    return [int.from_bytes(hashlib.blake2b('\x1f'.join((premise, hypothesis_template.format(label))).encode('utf-8'),
+                                          digest_size=4).digest(), 'little') / 2 ** 32 for premise, label in pairs]
+
+
+@contextmanager
+def stubbed_classifier():
+    entailment_scores = nli.entailment_scores
+    nli.entailment_scores = stub_entailment_scores
+    try:
+        yield
+    finally:
+        nli.entailment_scores = entailment_scores
+
+
+def profile(name, function, items, unit, repeat):
+    # The fastest of repeat runs and the peak memory allocated by Python and NumPy during one more run. A stage that
+    # cannot run, e.g. without the language identification model, is reported with its error.
+    try:
+        seconds, result = measure(function, repeat=repeat)
+        tracemalloc.start()
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    except Exception as error:
+        tracemalloc.stop()
+        print('{}: failed with {!r}'.format(name, error))
+        return {'name': name, 'unit': unit, 'items': items, 'error': repr(error)}, None
+    print('{}: {:.3f}s for {} {} ({:.0f}/s), peak memory {:.1f} MB'.format(name, seconds, items, unit,
+                                                                          items / seconds, peak_memory / 2 ** 20))
+    return {'name': name, 'unit': unit, 'items': items, 'seconds': seconds, 'items_per_second': items / seconds,
+            'peak_memory_bytes': peak_memory}, result
+
+
+def correct_spellings_inbound_uncached_copy(df):
+    with SpellingCache(':memory:', 'benchmark') as spelling_cache:
+        return preprocessing.correct_spellings_inbound(df.copy(), spelling_cache)
+
+
+def predict_uncached(df, df_nli_template):
+    with NLICache(':memory:', 'benchmark') as nlp_cache:
+        return nli.predict(df.copy(), df_nli_template, nlp_cache, batch_size=32)
+
+
+def to_event_log_uncached(df, df_activity_mappings, df_topic_mappings):
+    with NLICache(':memory:', 'benchmark') as nlp_cache:
+        return to_event_log(df.copy(), df_activity_mappings, df_topic_mappings, nlp_cache)
+
+
+def benchmark_stages(conversations, max_depth, companies, non_english, seed, repeat):
+    # Runs the hot functions of every stage on synthetic conversations, each on the output of the one before
+    results = []
+
+    def run(name, function, items, unit, default=None):
+        result, value = profile(name, function, items, unit, repeat)
+        results.append(result)
+        return default if value is None else value
+
+    df_twcs = synthetic_twcs.generate_conversations(conversations, max_depth, companies, non_english, seed=seed)
+    df = preprocessing.filter_outbound_tweets_by_company(df_twcs, list(companies))
+    df = run('add_main_tweet_id', lambda: preprocessing.add_main_tweet_id(df.copy()), len(df.index), 'tweets')
+    df = preprocessing.remove_conversations_with_multiple_companies(preprocessing.add_company(df))
+    df = run('remove_non_english_tweets', lambda: preprocessing.remove_non_english_tweets(df), len(df.index),
+             'tweets', default=df)
+    df = preprocessing.remove_non_conversational_tweets(df)
+    df = run('correct_spellings_inbound', lambda: correct_spellings_inbound_uncached_copy(df), len(df.index),
+             'tweets', default=df)
+
+    with stubbed_classifier():
+        for direction, names, name_column in (('inbound', synthetic_twcs.topics, 'Topic'),
+                                              ('outbound', synthetic_twcs.activities, 'Activity')):
+            df_direction = df[df['inbound'] == (direction == 'inbound')][['text']]
+            df_direction = pd.concat([df_direction, synthetic_twcs.label(df_direction['text'], names)], axis=1)
+            df_nli_template = synthetic_twcs.nli_template(names)
+            df_predicted = run('nli.predict ' + direction, lambda: predict_uncached(df_direction, df_nli_template),
+                               len(df_direction.index) * len(names), 'pairs')
+            if df_predicted is not None:
+                run('cross_validate_nli_template ' + direction,
+                    lambda: cross_validate_nli_template(df_predicted, df_nli_template), len(df_direction.index),
+                    'tweets')
+        df_event_log = run('to_event_log', lambda: to_event_log_uncached(
+            df, synthetic_twcs.mappings(synthetic_twcs.activities, 'Activity'),
+            synthetic_twcs.mappings(synthetic_twcs.topics, 'Topic')), len(df.index), 'tweets')
+    if df_event_log is None:
+        return results
+
+    from process_mining import algorithms, filter_classified_start_activities, run_discovery_job
+    from variant_index import VariantIndex
+
+    with tempfile.TemporaryDirectory() as path:
+        xes_file = os.path.join(path, 'twcs-synthetic.xes')
+        run('write_xes', lambda: write_xes(df_event_log, xes_file), len(df_event_log.index), 'events')
+        events = run('import_xes', lambda: import_xes(xes_file), len(df_event_log.index), 'events')
+        # The process models of the company with the most conversations, like process_mining.py with the
+        # variants_percentage_1.0 filter
+        company = max(companies, key=companies.get)
+        cases = df_event_log[df_event_log['company'] == company]['case:concept:name'].unique()
+        events = filter_classified_start_activities(
+            events[events['case:concept:name'].isin(cases)].reset_index(drop=True), company)
+        variant_index = run('VariantIndex.from_events', lambda: VariantIndex.from_events(events), len(events.index),
+                            'events')
+        for algorithm in algorithms:
+            job = (algorithm, variant_index, path, company + '-{algorithm}.png')
+            run(algorithm, lambda: run_discovery_job(job), len(variant_index.counts), 'variants')
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'packages': {name: sys.modules[name].__version__ for name in ('numpy', 'pandas', 'pyarrow', 'pm4py')
+                     if name in sys.modules},
+    }
+
+
+def compare(results, baseline_path):
+    # Speedup of every function against an earlier run, > 1 if it became faster
+    with open(baseline_path) as stream:
+        baseline = {result['name']: result for result in json.load(stream)['results'] if 'seconds' in result}
+    for result in results:
+        if 'seconds' in result and result['name'] in baseline:
+            before = baseline[result['name']]
+            print('{}: {:.2f}x faster per item than {}'.format(
+                result['name'], result['items'] / result['seconds'] / (before['items'] / before['seconds']),
+                baseline_path))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=10, help='How often to repeat the preprocessed Tweets.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of which the fastest one is reported.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes for the batched implementations.')
+    parser.add_argument('--startup-only', action='store_true',
+                        help='Only measure the startup time of the entry points, which needs no data.')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='Benchmark the hot functions of all stages on synthetic conversations instead.')
+    parser.add_argument('--conversations', type=int, default=10000, help='Number of synthetic conversations.')
+    parser.add_argument('--max-depth', type=int, default=6, help='Maximum number of replies per conversation.')
+    parser.add_argument('--companies', type=synthetic_twcs.parse_company_mix,
+                        default=synthetic_twcs.default_company_mix, help='Share of the conversations of each company.')
+    parser.add_argument('--non-english', type=float, default=0.1, help='Share of Tweets in another language.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic conversations.')
+    parser.add_argument('--output', help='JSON file to write the results to.')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare the results with.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    results = benchmark_startup(args.repeat)
+    if args.synthetic:
+        results += benchmark_stages(args.conversations, args.max_depth, args.companies, args.non_english, args.seed,
+                                    args.repeat)
+    elif not args.startup_only:
+        df = load_preprocessed_tweets(args.scale)
+        benchmark_remove_non_english_tweets(df, args.repeat, args.jobs)
+        benchmark_correct_spellings_inbound(df, args.repeat, args.jobs)
+
+    if args.baseline:
+        compare(results, args.baseline)
+    if args.output:
+        parameters = {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')}
+        with open(args.output, 'w') as stream:
+            json.dump({'created_at': pd.Timestamp.now().isoformat(), 'environment': environment(),
+                       'parameters': parameters, 'results': results}, stream, indent=1)
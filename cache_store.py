@@ -0,0 +1,176 @@
+import hashlib
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import instrumentation
+
+
+class SQLiteCache:
+
+    def __init__(self, path, table, value_type='REAL', max_memory_items=100000, commit_every=1000, timeout=60.0):
+        self.path = path
+        self.table = table
+        self.max_memory_items = max_memory_items
+        self.commit_every = commit_every
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.counter_names = tuple('cache.{}.{}'.format(table, counter) for counter in ('hits', 'misses', 'inserts'))
+        self.lock = threading.RLock()
+        # WAL lets any number of readers work next to one writer, the busy timeout makes concurrent writers wait for
+        # each other instead of failing
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (key BLOB PRIMARY KEY, value {}) WITHOUT ROWID'
+                                .format(table, value_type))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS migrations (source TEXT PRIMARY KEY)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                value = self.memory[key]
+            elif key in self.pending:
+                value = self.pending[key]
+            else:
+                row = self.connection.execute('SELECT value FROM {} WHERE key = ?'.format(self.table),
+                                              (key,)).fetchone()
+                if row is None:
+                    if instrumentation.enabled:
+                        instrumentation.count(self.counter_names[1])
+                    return default
+                value = row[0]
+                self._remember(key, value)
+        if instrumentation.enabled:
+            instrumentation.count(self.counter_names[0])
+        return value
+
+    def get_many(self, keys, chunk_size=500):
+        found = {}
+        with self.lock:
+            missing = []
+            unique_keys = OrderedDict.fromkeys(keys)
+            for key in unique_keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                elif key in self.pending:
+                    found[key] = self.pending[key]
+                else:
+                    missing.append(key)
+            for start in range(0, len(missing), chunk_size):
+                chunk = missing[start:start + chunk_size]
+                rows = self.connection.execute('SELECT key, value FROM {} WHERE key IN ({})'.format(
+                    self.table, ', '.join('?' * len(chunk))), chunk).fetchall()
+                for key, value in rows:
+                    self._remember(key, value)
+                    found[key] = value
+            if instrumentation.enabled:
+                instrumentation.count(self.counter_names[0], len(found))
+                instrumentation.count(self.counter_names[1], len(unique_keys) - len(found))
+        return found
+
+    def put(self, key, value):
+        if instrumentation.enabled:
+            instrumentation.count(self.counter_names[2])
+        with self.lock:
+            self._remember(key, value)
+            self.pending[key] = value
+            if len(self.pending) >= self.commit_every:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'.format(self.table),
+                                            self.pending.items())
+            self.pending.clear()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.connection.close()
+
+    def is_migrated(self, source):
+        return self.connection.execute('SELECT 1 FROM migrations WHERE source = ?', (source,)).fetchone() is not None
+
+    def mark_migrated(self, source):
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO migrations (source) VALUES (?)', (source,))
+
+
+class NLICache(SQLiteCache):
+
+    def __init__(self, path, model_id, **kwargs):
+        super().__init__(path, 'nli_scores', value_type='REAL', **kwargs)
+        self.model_id = model_id
+
+    def key(self, text, label, hypothesis_template):
+        fields = (self.model_id, hypothesis_template, str(text), str(label))
+        return hashlib.blake2b('\x1f'.join(fields).encode('utf-8'), digest_size=16).digest()
+
+    def lookup(self, text, label, hypothesis_template="{}."):
+        return self.get(self.key(text, label, hypothesis_template))
+
+    def lookup_many(self, pairs, hypothesis_template="{}."):
+        keys = {pair: self.key(pair[0], pair[1], hypothesis_template) for pair in pairs}
+        found = self.get_many(keys.values())
+        return {pair: found[key] for pair, key in keys.items() if key in found}
+
+    def store(self, text, label, score, hypothesis_template="{}."):
+        self.put(self.key(text, label, hypothesis_template), score)
+
+    def migrate_pickle(self, pickle_path, hypothesis_template="{}."):
+        # The pickled dict maps text + '__' + label to the score and was always filled using the default template
+        if self.is_migrated(pickle_path):
+            return 0
+        with open(pickle_path, 'rb') as stream:
+            try:
+                legacy_cache = pickle.load(stream)
+            except EOFError:
+                legacy_cache = dict()
+        for legacy_key, score in legacy_cache.items():
+            text, label = legacy_key.rsplit('__', 1)
+            self.store(text, label, score, hypothesis_template)
+        self.flush()
+        self.mark_migrated(pickle_path)
+        return len(legacy_cache)
+
+
+class SpellingCache(SQLiteCache):
+
+    def __init__(self, path, checker_id, **kwargs):
+        super().__init__(path, 'corrections', value_type='TEXT', **kwargs)
+        self.checker_id = checker_id
+
+    def key(self, word):
+        return hashlib.blake2b('\x1f'.join((self.checker_id, word)).encode('utf-8'), digest_size=16).digest()
+
+    def lookup_many(self, words):
+        keys = {word: self.key(word) for word in words}
+        found = self.get_many(keys.values())
+        return {word: found[key] for word, key in keys.items() if key in found}
+
+    def store(self, word, correction):
+        self.put(self.key(word), correction)
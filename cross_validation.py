@@ -1,12 +1,24 @@
+import argparse
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics import matthews_corrcoef, accuracy_score, balanced_accuracy_score, f1_score
-from sklearn.model_selection import StratifiedKFold
 
+import instrumentation
+from stage_io import find_stage_file, list_stage_files, read_stage
 
-np.random.seed(1868)
+
+seed = 1868
+
+np.random.seed(seed)
+
+# Order in which the files of the published results in results/nli-cv were cross-validated. The folds are drawn from
+# the global random state, so the results of a file depend on the files before it. Other files are evaluated last.
+file_order = ['twcs-AmazonHelp-100-outbound-predicted', 'twcs-SpotifyCares-100-outbound-predicted',
+              'twcs-AmazonHelp-200-inbound-predicted', 'twcs-AppleSupport-100-outbound-predicted',
+              'twcs-SpotifyCares-200-inbound-predicted', 'twcs-AppleSupport-200-inbound-predicted']
 
 thresholds = list(reversed([0.7 + x * 0.01 for x in range(0, 29)] + [0.98 + x * 0.001 for x in range(0, 20)]))
 
@@ -16,8 +28,11 @@ def parse_filename(filename):
     return company, tweets, direction
 
 
-def cross_validate_nli_template(df, df_nli_template):
-    results = []
+def cross_validation_tasks(df, df_nli_template, thresholds=thresholds, resample_folds=True, random_state=None):
+    # The folds are drawn here from random_state, or the global random state if it is None, in the order and as often
+    # as the former serial loop drew them, and only their indices are passed on, so the results do not depend on
+    # whether or how the tasks are distributed over processes
+    from sklearn.model_selection import StratifiedKFold
     for header in list(df_nli_template):
         hypotheses = df_nli_template[header].dropna().values.tolist()
         if len(hypotheses) == 0:
@@ -25,27 +40,95 @@ def cross_validate_nli_template(df, df_nli_template):
         for hypothesis in hypotheses:
             num_positive_instances = len(df[df[header] == 1].index)
             if num_positive_instances >= 3:
-                y_true = df[header]
-                y_probabilities = df['pred_' + header + '_' + hypothesis]
-                skf = StratifiedKFold(n_splits=min(num_positive_instances, 5), shuffle=True)
-                threshold_results = []
-                for threshold in thresholds:
-                    fold_results = []
-                    for i, splits in enumerate(skf.split(y_probabilities, y_true)):
-                        _, test = splits
-                        y_predicted = y_probabilities[test].apply(lambda x: 1 if x > threshold else 0)
-                        fold_results.append((threshold,) + evaluate_predictions(y_true[test], y_predicted))
-                    threshold_results.append(tuple(map(lambda y: sum(y) / float(len(y)), zip(*fold_results))))
-                optimal_threshold = max(threshold_results, key=lambda item: item[1])[0]
-                predictions = df['pred_' + header + '_' + hypothesis].apply(lambda x: 1 if x > optimal_threshold else 0)
-                evaluation = evaluate_predictions(df[header], predictions)
-                results.append((header, hypothesis, optimal_threshold) + evaluation)
-    df_results = pd.DataFrame(results, columns=['Header', 'Label', 'Optimal Threshold', 'MCC', 'Accuracy',
-                                                'Balanced Accuracy', 'F1', 'Items'])
+                y_true = df[header].values
+                y_probabilities = df['pred_' + header + '_' + hypothesis].values
+                skf = StratifiedKFold(n_splits=min(num_positive_instances, 5), shuffle=True,
+                                      random_state=random_state)
+                if resample_folds:
+                    # Every threshold is evaluated on its own shuffle of the folds
+                    splits = [[test for _, test in skf.split(y_probabilities, y_true)] for _ in thresholds]
+                else:
+                    splits = [[test for _, test in skf.split(y_probabilities, y_true)]]
+                yield header, hypothesis, y_true, y_probabilities, thresholds, splits
+
+
+def evaluate_hypothesis(task):
+    header, hypothesis, y_true, y_probabilities, thresholds, splits = task
+    averaged_thresholds, mcc, _, _, _ = sweep_thresholds(y_true, y_probabilities, thresholds, splits)
+    optimal_threshold = averaged_thresholds[np.argmax(mcc)]
+    predictions = pd.Series(np.where(y_probabilities > optimal_threshold, 1, 0))
+    evaluation = evaluate_predictions(pd.Series(y_true), predictions)
+    return (header, hypothesis, optimal_threshold) + evaluation
+
+
+def cross_validate_nli_template(df, df_nli_template, thresholds=thresholds, resample_folds=True, executor=None,
+                                random_state=None):
+    tasks = cross_validation_tasks(df, df_nli_template, thresholds, resample_folds, random_state)
+    if executor is None:
+        results = map(evaluate_hypothesis, tasks)
+    else:
+        results = executor.map(evaluate_hypothesis, list(tasks), chunksize=8)
+    df_results = pd.DataFrame(list(results), columns=['Header', 'Label', 'Optimal Threshold', 'MCC', 'Accuracy',
+                                                      'Balanced Accuracy', 'F1', 'Items'])
     return df_results
 
 
+def confusion_counts(y_true, y_probabilities, thresholds):
+    # Confusion matrix of the predictions y_probabilities > threshold for all thresholds with a single sort
+    order = np.argsort(-y_probabilities, kind='mergesort')
+    true_positives = np.concatenate([[0], np.cumsum(y_true[order] == 1)])
+    predicted_positives = np.searchsorted(-y_probabilities[order], -np.asarray(thresholds), side='left')
+    tp = true_positives[predicted_positives]
+    fp = predicted_positives - tp
+    fn = true_positives[-1] - tp
+    tn = len(y_true) - tp - fp - fn
+    return tp, fp, tn, fn
+
+
+def evaluate_confusion_counts(tp, fp, tn, fn):
+    # Same arithmetic as sklearn's matthews_corrcoef, accuracy_score, balanced_accuracy_score and f1_score so that
+    # the results are identical to evaluate_predictions
+    tp, fp, tn, fn = (np.asarray(count, dtype=np.float64) for count in (tp, fp, tn, fn))
+    n_samples = tp + fp + tn + fn
+    true_negatives, true_positives = tn + fp, tp + fn
+    predicted_negatives, predicted_positives = tn + fn, tp + fp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov_ytyp = (tp + tn) * n_samples - (true_negatives * predicted_negatives + true_positives * predicted_positives)
+        cov_ypyp = n_samples ** 2 - (predicted_negatives * predicted_negatives + predicted_positives * predicted_positives)
+        cov_ytyt = n_samples ** 2 - (true_negatives * true_negatives + true_positives * true_positives)
+        mcc = cov_ytyp / np.sqrt(cov_ytyt * cov_ypyp)
+        mcc[np.isnan(mcc)] = 0.
+        accuracy = (tp + tn) / n_samples
+        recall_negative = tn / true_negatives
+        recall_positive = tp / true_positives
+        balanced_accuracy = np.where(np.isnan(recall_negative), recall_positive,
+                                     np.where(np.isnan(recall_positive), recall_negative,
+                                              (recall_negative + recall_positive) / 2))
+        precision = np.where(predicted_positives == 0, 0., tp / predicted_positives)
+        recall = np.where(true_positives == 0, 0., tp / true_positives)
+    denominator = precision + recall
+    denominator[denominator == 0.] = 1
+    f1 = 2 * precision * recall / denominator
+    return mcc, accuracy, balanced_accuracy, f1
+
+
+def sweep_thresholds(y_true, y_probabilities, thresholds, splits):
+    # splits holds either the test folds of every single threshold or one list of test folds shared by all thresholds
+    thresholds = np.asarray(thresholds)
+    n_folds = len(splits[0])
+    if len(splits) == 1:
+        counts = [confusion_counts(y_true[test], y_probabilities[test], thresholds) for test in splits[0]]
+    else:
+        counts = [np.hstack([confusion_counts(y_true[tests[fold]], y_probabilities[tests[fold]], thresholds[[i]])
+                             for i, tests in enumerate(splits)]) for fold in range(n_folds)]
+    fold_results = [evaluate_confusion_counts(*fold_counts) for fold_counts in counts]
+    averaged_thresholds = np.array([sum([threshold] * n_folds) / float(n_folds) for threshold in thresholds])
+    return (averaged_thresholds,) + tuple(sum(metric) / float(n_folds) for metric in zip(*fold_results))
+
+
 def evaluate_predictions(y_true, y_pred):
+    # scikit-learn is imported on first use, so that importing the helpers of this module stays cheap
+    from sklearn.metrics import matthews_corrcoef, accuracy_score, balanced_accuracy_score, f1_score
     mcc = matthews_corrcoef(y_true, y_pred)
     accuracy = accuracy_score(y_true, y_pred)
     balanced_accuracy = balanced_accuracy_score(y_true, y_pred)
@@ -54,26 +137,63 @@ def evaluate_predictions(y_true, y_pred):
     return mcc, accuracy, balanced_accuracy, f1, items
 
 
+def template_columns(df_nli_template):
+    # The labels and the predictions of the hypotheses of the template, the only columns the cross-validation reads
+    columns = []
+    for header in list(df_nli_template):
+        hypotheses = df_nli_template[header].dropna().values.tolist()
+        if len(hypotheses) > 0:
+            columns += [header] + ['pred_' + header + '_' + hypothesis for hypothesis in hypotheses]
+    return list(OrderedDict.fromkeys(columns))
+
+
+def cross_validate_file(filename, executor=None, seed=None):
+    company, tweets, direction = parse_filename(filename)
+    nli_template = 'twcs-{}-nli'.format(company)
+    df_nli_template = read_stage(find_stage_file(os.path.join('data', 'nli-templates', direction), nli_template))
+    df = read_stage(os.path.join('data', 'predicted', filename), columns=template_columns(df_nli_template),
+                    memory_map=True, index_col=[0])
+    with instrumentation.stage('cross_validation.cross_validate_nli_template') as timer:
+        # Without a seed the folds are drawn from the global random state, which reproduces the published results of
+        # a run over all files. With a seed, e.g. in the pipeline, which reruns only the stale files, the results of a
+        # file do not depend on which files were evaluated before it in the same process.
+        random_state = np.random.RandomState(seed) if seed is not None else None
+        df_results = cross_validate_nli_template(df, df_nli_template, executor=executor, random_state=random_state)
+        timer.rows = len(df_results.index)
+    outfile = 'cv_results-{}-{}.xlsx'.format(company, direction)
+    writer = pd.ExcelWriter(os.path.join('results', 'nli-cv', outfile), engine='xlsxwriter')
+    df_results.to_excel(writer, sheet_name='Sheet1')
+    workbook = writer.book
+    worksheet = writer.sheets['Sheet1']
+    for column in ['E', 'F', 'G', 'H']:
+        worksheet.conditional_format('{}2:{}{}'.format(column, column, str(len(df_results.index) + 1)),
+                                     {'type': '3_color_scale'})
+    writer.save()
+    return os.path.join('results', 'nli-cv', outfile)
+
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes to evaluate the hypotheses with.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+
     if not os.path.exists('results'):
         os.mkdir('results')
 
     if not os.path.exists(os.path.join('results', 'nli-cv')):
         os.mkdir(os.path.join('results', 'nli-cv'))
 
-    for filename in os.listdir(os.path.join('data', 'predicted')):
-        company, tweets, direction = parse_filename(filename)
-        df = pd.read_excel(os.path.join('data', 'predicted', filename), index_col=[0])
-        nli_template = 'twcs-{}-nli.xlsx'.format(company)
-        df_nli_template = pd.read_excel(os.path.join('data', 'nli-templates', direction, nli_template))
-        df_results = cross_validate_nli_template(df, df_nli_template)
-        outfile = 'cv_results-{}-{}.xlsx'.format(company, direction)
-        writer = pd.ExcelWriter(os.path.join('results', 'nli-cv', outfile), engine='xlsxwriter')
-        df_results.to_excel(writer, sheet_name='Sheet1')
-        workbook = writer.book
-        worksheet = writer.sheets['Sheet1']
-        for column in ['E', 'F', 'G', 'H']:
-            worksheet.conditional_format('{}2:{}{}'.format(column, column, str(len(df_results.index) + 1)),
-                                         {'type': '3_color_scale'})
-        writer.save()
+    filenames = list_stage_files(os.path.join('data', 'predicted'))
+    filenames.sort(key=lambda filename: file_order.index(os.path.splitext(filename)[0])
+                   if os.path.splitext(filename)[0] in file_order else len(file_order))
+    for filename in filenames:
+        cross_validate_file(filename, executor=executor)
+
+    if executor is not None:
+        executor.shutdown()
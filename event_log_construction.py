@@ -1,13 +1,16 @@
 import argparse
 import os
-import pickle
 
+import numpy as np
 import pandas as pd
-from pm4py.objects.conversion.log import converter as log_converter
-from pm4py.objects.log.exporter.xes import exporter as xes_exporter
-from pm4py.objects.log.util import dataframe_utils
 
-from nli import nlp
+import instrumentation
+from nli import classifier, nlp_batch, open_nlp_cache
+from stage_io import find_stage_file, list_stage_files, read_stage
+from xes_io import write_xes
+
+# The columns of the preprocessed conversations that become attributes of the events
+conversation_columns = ['main_tweet_id', 'tweet_id', 'created_at', 'author_id', 'text', 'company']
 
 
 def parse_filename(filename):
@@ -15,24 +18,41 @@ def parse_filename(filename):
     return company, tweets
 
 
-def append_activities_and_topics(row, df_activity_mappings, df_topic_mappings, nlp_cache):
-    activities_topics = []
-    if row['author_id'] == row['company']:
-        nlp_results = nlp(str(row['text']), list(df_activity_mappings['Label']), nlp_cache)
-        for label, probability in nlp_results.items():
-            label = label[5:]
-            if probability > list(df_activity_mappings[df_activity_mappings['Label'] == label]['Optimal Threshold'])[0]:
-                activities_topics.append(
-                    list(df_activity_mappings[df_activity_mappings['Label'] == label]['Activity'])[0])
-    elif row['tweet_id'] == row['main_tweet_id']:
-        nlp_results = nlp(str(row['text']), list(df_topic_mappings['Label']), nlp_cache)
-        for label, probability in nlp_results.items():
-            label = label[5:]
-            if probability > list(df_topic_mappings[df_topic_mappings['Label'] == label]['Optimal Threshold'])[0]:
-                activities_topics.append(
-                    list(df_topic_mappings[df_topic_mappings['Label'] == label]['Topic'])[0])
-    row['activities_topics'] = activities_topics
-    return row
+def compile_mappings(df_mappings, name_column):
+    # The first row of a label determines its threshold and activity/topic, like the former per-row lookups did
+    df_mappings = df_mappings.drop_duplicates('Label', keep='first')
+    return (df_mappings['Label'].tolist(), df_mappings['Optimal Threshold'].values.astype(np.float64),
+            df_mappings[name_column].values)
+
+
+def classify_tweets(texts, mappings, nlp_cache, batch_size=32):
+    labels, thresholds, names = mappings
+    scores = nlp_batch(texts, labels, nlp_cache, batch_size=batch_size).values
+    rows, columns = np.nonzero(scores > thresholds)
+    return [list(row_names) for row_names in np.split(names[columns], np.searchsorted(rows, np.arange(1, len(texts))))]
+
+
+def append_activities_and_topics(df, activity_mappings, topic_mappings, nlp_cache, batch_size=32):
+    # Company Tweets are labeled with activities, the opening Tweets of the customers with topics
+    company_tweets = (df['author_id'] == df['company']).values
+    opening_tweets = ~company_tweets & (df['tweet_id'] == df['main_tweet_id']).values
+    activities_topics = [[] for _ in range(len(df.index))]
+    for tweets, mappings in ((company_tweets, activity_mappings), (opening_tweets, topic_mappings)):
+        if tweets.any():
+            texts = df.loc[tweets, 'text'].astype(str)
+            for position, names in zip(np.flatnonzero(tweets), classify_tweets(texts, mappings, nlp_cache, batch_size)):
+                activities_topics[position] = names
+    df['activities_topics'] = activities_topics
+    return df
+
+
+def unescape_twitter_entities(texts):
+    # Twitter escapes &, < and > in the texts, the spelling correction sometimes splits '&amp;' into '& amp;'. The
+    # XES writer escapes the plain characters again.
+    return (texts.str.replace('& amp;', '&amp;', regex=False)
+            .str.replace('&lt;', '<', regex=False)
+            .str.replace('&gt;', '>', regex=False)
+            .str.replace('&amp;', '&', regex=False))
 
 
 def rename_df_for_xes(df):
@@ -45,61 +65,72 @@ def rename_df_for_xes(df):
     return df.rename(mapping, axis=1)
 
 
-def to_event_log(df_conversations, df_activity_mappings, df_topic_mappings, nlp_cache):
-    df_conversations = df_conversations.drop(df_conversations.columns[[0]], axis=1)
-    df_conversations = df_conversations.drop(['in_response_to_tweet_id', 'response_tweet_id', 'inbound'], axis=1)
-    df_event_log = df_conversations.apply(lambda row: append_activities_and_topics(row, df_activity_mappings, df_topic_mappings, nlp_cache), axis=1)
+def to_event_log(df_conversations, df_activity_mappings, df_topic_mappings, nlp_cache, batch_size=32):
+    df_conversations = df_conversations[conversation_columns]
+    activity_mappings = compile_mappings(df_activity_mappings, 'Activity')
+    topic_mappings = compile_mappings(df_topic_mappings, 'Topic')
+    with instrumentation.stage('event_log_construction.classify', rows=len(df_conversations.index)):
+        df_event_log = append_activities_and_topics(df_conversations, activity_mappings, topic_mappings, nlp_cache,
+                                                    batch_size)
 
-    with open('nlp_cache.pkl', 'wb+') as outfile:
-        pickle.dump(nlp_cache, outfile)
+    nlp_cache.flush()
 
-    df_event_log['text'] = df_event_log['text'].map(lambda x: x.replace('"', r'\''))
-    df_event_log['text'] = df_event_log['text'].map(lambda x: x.replace('<', r'&lt;'))
-    df_event_log['text'] = df_event_log['text'].map(lambda x: x.replace('>', r'&gt;'))
-    df_event_log['text'] = df_event_log['text'].map(lambda x: x.replace('& amp;', r'&amp;'))
-    df_event_log['text'] = df_event_log['text'].map(lambda x: x.replace('&', r'&amp;') if x.endswith('&') else x)
+    df_event_log['text'] = unescape_twitter_entities(df_event_log['text'].astype(str))
+    # The conversation IDs may come as floats from the preprocessing but have always been written as integers
+    df_event_log['main_tweet_id'] = df_event_log['main_tweet_id'].astype(np.int64)
 
     df_event_log = rename_df_for_xes(df_event_log)
     df_event_log = df_event_log.explode('concept:name')
     df_event_log = df_event_log[df_event_log['concept:name'].notna()]
+    df_event_log['time:timestamp'] = pd.to_datetime(df_event_log['time:timestamp'])
+    return df_event_log
 
-    event_log = dataframe_utils.convert_timestamp_columns_in_df(df_event_log)
-    event_log = log_converter.apply(event_log)
-    return event_log
 
+def construct_event_log(conversations_file, save_path, nlp_cache, batch_size=32, compress=False):
+    company, tweets = parse_filename(os.path.basename(conversations_file))
+    mappings_path = os.path.join('data', 'topics-activities')
+    activity_mappings_file = find_stage_file(mappings_path, 'twcs-' + company + '-outbound-activities')
+    topic_mappings_file = find_stage_file(mappings_path, 'twcs-' + company + '-inbound-topics')
 
-if __name__ == '__main__':
+    df_activity_mappings = read_stage(activity_mappings_file)
+    df_topic_mappings = read_stage(topic_mappings_file)
+    df_conversations = read_stage(conversations_file, columns=conversation_columns, memory_map=True, index_col=[0])
 
-    if not os.path.exists('nlp_cache.pkl'):
-        open('nlp_cache.pkl', 'wb+').close()
-    nlp_cache_stream = open('nlp_cache.pkl', 'rb')
-    try:
-        nlp_cache = pickle.load(nlp_cache_stream)
-    except EOFError:
-        nlp_cache = dict()
-    nlp_cache_stream.close()
+    df_event_log = to_event_log(df_conversations, df_activity_mappings, df_topic_mappings, nlp_cache, batch_size)
+
+    extension = '.xes.gz' if compress else '.xes'
+    path = os.path.join(save_path, 'twcs-' + company + '-' + tweets + extension)
+    with instrumentation.stage('event_log_construction.write_xes', rows=len(df_event_log.index)):
+        write_xes(df_event_log, path)
+    return path
+
+
+if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-path', help='Path where to find the data to convert.')
     parser.add_argument('--save-path', help='Path where to save the converted data.')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of Tweets and hypotheses per NLI batch.')
+    parser.add_argument('--compress', action='store_true', help='Write gzip-compressed .xes.gz files.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='Load the NLI model in the background right away instead of on first use.')
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
+    instrumentation.start_from_arguments(args)
+
+    if args.warm_start:
+        classifier.warm_start()
+
     data_path = args.data_path if args.data_path else os.path.join('data', 'preprocessed')
     save_path = args.save_path if args.save_path else 'xes'
 
     if not args.save_path and not os.path.exists('xes'):
         os.mkdir('xes')
 
-    for filename in [filename for filename in os.listdir(data_path) if filename.startswith('twcs')]:
-        company, tweets = parse_filename(filename.split('/')[-1])
-        activity_mappings_file = os.path.join('data', 'topics-activities', 'twcs-' + company + '-outbound-activities.xlsx')
-        topic_mappings_file = os.path.join('data', 'topics-activities', 'twcs-' + company + '-inbound-topics.xlsx')
-        conversations_file = os.path.join(data_path, filename.split('/')[-1])
-
-        df_activity_mappings = pd.read_excel(activity_mappings_file)
-        df_topic_mappings = pd.read_excel(topic_mappings_file)
-        df_conversations = pd.read_excel(conversations_file)
+    nlp_cache = open_nlp_cache()
 
-        event_log = to_event_log(df_conversations, df_activity_mappings, df_topic_mappings, nlp_cache)
+    for filename in [filename for filename in list_stage_files(data_path) if filename.startswith('twcs')]:
+        construct_event_log(os.path.join(data_path, filename), save_path, nlp_cache, args.batch_size, args.compress)
 
-        xes_exporter.apply(event_log, os.path.join(save_path, 'twcs-' + company + '-' + tweets + '.xes'))
+    nlp_cache.close()
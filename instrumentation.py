@@ -0,0 +1,175 @@
+import atexit
+import cProfile
+import json
+import os
+import signal
+import sys
+import time
+from array import array
+from collections import defaultdict
+
+# Off unless a script runs with --metrics or --profile, so that the calls in the hot paths cost no more than a check
+# of this flag
+enabled = False
+
+# Per stage the duration and the number of items, e.g. Tweets or (Tweet, hypothesis) pairs, of every call
+stage_seconds = defaultdict(lambda: array('d'))
+stage_rows = defaultdict(lambda: array('d'))
+counters = defaultdict(int)
+
+metrics_path = None
+profiler = None
+profiler_path = None
+started_at = None
+start_time = None
+
+
+class Timer:
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        # May also be set inside the block, once the number of items is known
+        self.rows = rows
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        record(self.name, time.perf_counter() - self.start, self.rows)
+        return False
+
+
+class NullTimer:
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+null_timer = NullTimer()
+
+
+def stage(name, rows=None):
+    # Times the block as a call of the stage name, e.g. with stage('nli.model', rows=len(batch)): ...
+    return Timer(name, rows) if enabled else null_timer
+
+
+def record(name, seconds, rows=None):
+    if enabled:
+        stage_seconds[name].append(seconds)
+        if rows is not None:
+            stage_rows[name].append(rows)
+
+
+def count(name, n=1):
+    if enabled:
+        counters[name] += n
+
+
+def distribution(values):
+    import numpy as np
+    values = np.frombuffer(values, dtype=np.float64)
+    percentiles = np.percentile(values, [50, 90, 99])
+    return {'mean': float(values.mean()), 'p50': float(percentiles[0]), 'p90': float(percentiles[1]),
+            'p99': float(percentiles[2]), 'max': float(values.max())}
+
+
+def peak_rss():
+    # Peak resident set size in bytes of this process and of the largest of its finished child processes, e.g. the
+    # workers of a pool. ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def summary():
+    stages = {}
+    for name, seconds in stage_seconds.items():
+        total = sum(seconds)
+        stages[name] = {'calls': len(seconds), 'seconds': total, 'latency_seconds': distribution(seconds)}
+        if len(stage_rows[name]) > 0:
+            rows = sum(stage_rows[name])
+            stages[name]['rows'] = int(rows)
+            stages[name]['rows_per_second'] = rows / total if total > 0 else None
+            stages[name]['batch_rows'] = distribution(stage_rows[name])
+    # Hit rate of every cache with hit and miss counters, e.g. cache.nli_scores
+    hit_rates = {}
+    for name in counters:
+        if name.endswith('.hits'):
+            cache = name[:-len('.hits')]
+            lookups = counters[name] + counters.get(cache + '.misses', 0)
+            hit_rates[cache] = counters[name] / lookups if lookups > 0 else None
+    return {
+        'script': os.path.basename(sys.argv[0]),
+        'argv': sys.argv[1:],
+        'started_at': started_at,
+        'seconds': time.perf_counter() - start_time if start_time is not None else None,
+        'stages': stages,
+        'counters': dict(counters),
+        'cache_hit_rates': hit_rates,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def write_summary(path=None):
+    path = path or metrics_path
+    if path is None:
+        return
+    content = json.dumps(summary(), indent=1, sort_keys=True)
+    if path == '-':
+        print(content, file=sys.stderr)
+        return
+    with open(path + '.tmp', 'w') as stream:
+        stream.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def finish():
+    global profiler
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profiler_path)
+        profiler = None
+    write_summary()
+
+
+def start_instrumentation(path=None, profile_path=None):
+    # Collects the metrics from now on and writes them to path when the process exits, and on SIGUSR1 while it runs,
+    # e.g. for the streaming event log construction with --follow. profile_path gets the cProfile statistics of the
+    # whole run, which e.g. snakeviz can show. Sampling profilers such as py-spy need no hook and attach to any run.
+    global enabled, metrics_path, profiler, profiler_path, started_at, start_time
+    enabled = True
+    metrics_path = path
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    start_time = time.perf_counter()
+    if profile_path is not None:
+        profiler_path = profile_path
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if path is not None and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda *_: write_summary())
+    atexit.register(finish)
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics',
+                        help='Write timers, throughput, batch sizes, latency percentiles, cache counters and the peak '
+                             'memory as JSON to this file, - for stderr.')
+    parser.add_argument('--profile', help='Write cProfile statistics of the run to this file.')
+
+
+def start_from_arguments(args):
+    if args.metrics is not None or args.profile is not None:
+        start_instrumentation(args.metrics, args.profile)
@@ -1,7 +1,13 @@
+import argparse
 import os
+from collections import deque
 
+import numpy as np
 import pandas as pd
+
+import instrumentation
 from cross_validation import evaluate_predictions
+from stage_io import find_stage_file, list_stage_files, read_stage, write_stage
 
 
 def parse_filename(filename):
@@ -13,30 +19,144 @@ def predict(text, keyword):
     return 1 if keyword.lower() in text.lower() else 0
 
 
+def build_automaton(patterns):
+    # Aho-Corasick automaton over the UTF-8 bytes of the patterns. The failure links are folded into a full transition
+    # table with a row of 256 next states per state, and matches holds which patterns end in each state, including
+    # the patterns that end in the states reached by following its failure links.
+    children = [{}]
+    outputs = [[]]
+    for i, pattern in enumerate(patterns):
+        state = 0
+        for byte in pattern.encode('utf-8'):
+            if byte not in children[state]:
+                children.append({})
+                outputs.append([])
+                children[state][byte] = len(children) - 1
+            state = children[state][byte]
+        outputs[state].append(i)
+    transitions = np.zeros((len(children), 256), dtype=np.int64)
+    matches = np.zeros((len(children), len(patterns)), dtype=bool)
+    for byte, child in children[0].items():
+        transitions[0, byte] = child
+    matches[0, outputs[0]] = True
+    failures = [0] * len(children)
+    # In breadth-first order the failure state of a state, which is shallower, is always complete already
+    queue = deque(children[0].values())
+    while len(queue) > 0:
+        state = queue.popleft()
+        failure = failures[state]
+        transitions[state] = transitions[failure]
+        for byte, child in children[state].items():
+            transitions[state, byte] = child
+            if state != 0:
+                failures[child] = transitions[failure, byte]
+            queue.append(child)
+        matches[state, outputs[state]] = True
+        matches[state] |= matches[failure]
+    return transitions, matches
+
+
+class KeywordMatcher:
+
+    def __init__(self, keywords):
+        # A substring of a text is a substring of its UTF-8 encoding and vice versa, so matching the bytes of the
+        # lowercased keywords in the bytes of the lowercased texts gives exactly keyword.lower() in text.lower()
+        self.keywords = list(keywords)
+        self.transitions, self.matches = build_automaton([keyword.lower() for keyword in self.keywords])
+        # The patterns ending in each state as bit masks of 64 patterns per word
+        self.bits = np.zeros((len(self.matches), max(1, -(-len(self.keywords) // 64))), dtype=np.uint64)
+        for i in range(len(self.keywords)):
+            self.bits[self.matches[:, i], i // 64] |= np.uint64(1 << (i % 64))
+
+    def match(self, texts, chunk_size=10000):
+        # Runs the automaton over the distinct texts in a single pass, one byte position at a time for a chunk of texts
+        # sorted by length, and returns whether each keyword occurs in each text
+        unique_texts = {}
+        codes = np.array([unique_texts.setdefault(text, len(unique_texts)) for text in texts], dtype=np.int64)
+        encoded = [text.lower().encode('utf-8') for text in unique_texts]
+        lengths = np.array([len(text) for text in encoded], dtype=np.int64)
+        order = np.argsort(lengths, kind='stable')
+        data = np.frombuffer(b''.join([encoded[i] for i in order]), dtype=np.uint8)
+        offsets = np.r_[0, np.cumsum(lengths[order])]
+        flat_transitions = self.transitions.ravel()
+        found = np.zeros((len(encoded), self.bits.shape[1]), dtype=np.uint64)
+        for start in range(0, len(order), chunk_size):
+            rows = order[start:start + chunk_size]
+            chunk_lengths = lengths[rows]
+            width = chunk_lengths[-1]
+            chunk = np.zeros((len(rows), width), dtype=np.uint8)
+            chunk[np.arange(width) < chunk_lengths[:, None]] = data[offsets[start]:offsets[start + len(rows)]]
+            chunk_found = self.bits[np.zeros(len(rows), dtype=np.int64)]
+            # Only the texts from first on are longer than the current position, so the padding is never read
+            first = 0
+            states = np.zeros(len(rows), dtype=np.int64)
+            for position in range(width):
+                next_first = np.searchsorted(chunk_lengths, position, side='right')
+                states = flat_transitions[states[next_first - first:] * 256 + chunk[next_first:, position]]
+                first = next_first
+                chunk_found[first:] |= self.bits[states]
+            found[rows] = chunk_found
+        indicators = np.zeros((len(encoded), len(self.keywords)), dtype=bool)
+        for i in range(len(self.keywords)):
+            indicators[:, i] = (found[:, i // 64] >> np.uint64(i % 64)) & np.uint64(1) == 1
+        return indicators[codes]
+
+
+def keyword_indicators(texts, mapping):
+    # 1 for each Tweet and topic/activity whose keyword occurs in the Tweet, 0 otherwise
+    matcher = KeywordMatcher(mapping.values())
+    with instrumentation.stage('keyword_classification.match', rows=len(texts.index)):
+        indicators = matcher.match(texts.values)
+    return pd.DataFrame(indicators.astype(np.int64), index=texts.index, columns=list(mapping))
+
+
+def classify_preprocessed(company, direction, mapping):
+    # Keyword indicators for all Tweets of the direction in the preprocessed conversations of the company
+    conversations_file = [filename for filename in list_stage_files(os.path.join('data', 'preprocessed'))
+                          if filename.startswith('twcs-{}-preprocessed'.format(company))][0]
+    df = read_stage(os.path.join('data', 'preprocessed', conversations_file),
+                    columns=['main_tweet_id', 'tweet_id', 'inbound', 'text'], memory_map=True, index_col=[0])
+    df = df[df['inbound'] == (direction == 'inbound')]
+    return pd.concat([df[['main_tweet_id', 'tweet_id', 'text']], keyword_indicators(df['text'], mapping)], axis=1)
+
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preprocessed', action='store_true',
+                        help='Also classify all Tweets of the preprocessed conversations by their keywords.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
     if not os.path.exists('results'):
         os.mkdir('results')
 
     if not os.path.exists(os.path.join('results', 'keyword-classification')):
         os.mkdir(os.path.join('results', 'keyword-classification'))
 
-    for filename in os.listdir(os.path.join('data', 'topics-activities')):
+    if args.preprocessed and not os.path.exists(os.path.join('data', 'keyword-classified')):
+        os.mkdir(os.path.join('data', 'keyword-classified'))
+
+    for filename in list_stage_files(os.path.join('data', 'topics-activities')):
         company, direction, type = parse_filename(filename)
-        df_mapping = pd.read_excel(os.path.join('data', 'topics-activities', filename))
+        df_mapping = read_stage(os.path.join('data', 'topics-activities', filename))
         df = None
         mapping = None
         if type == 'topics':
-            df = pd.read_excel(os.path.join('data', 'labeled', 'twcs-{}-200-inbound.xlsx'.format(company)))
             mapping = dict(zip(df_mapping.Topic, df_mapping.Keyword))
+            df = read_stage(find_stage_file(os.path.join('data', 'labeled'), 'twcs-{}-200-inbound'.format(company)),
+                            columns=['text'] + list(mapping), memory_map=True)
         else:
-            df = pd.read_excel(os.path.join('data', 'labeled', 'twcs-{}-100-outbound.xlsx'.format(company)))
             mapping = dict(zip(df_mapping.Activity, df_mapping.Keyword))
+            df = read_stage(find_stage_file(os.path.join('data', 'labeled'), 'twcs-{}-100-outbound'.format(company)),
+                            columns=['text'] + list(mapping), memory_map=True)
         df = df.fillna(0)
+        df_predictions = keyword_indicators(df['text'], mapping)
         results = []
         for item, keyword in mapping.items():
-            predictions = df['text'].apply(lambda x: predict(x, keyword))
-            results.append((item, keyword) + evaluate_predictions(df[item], predictions))
+            results.append((item, keyword) + evaluate_predictions(df[item], df_predictions[item]))
         df_results = pd.DataFrame(results, columns=['Topic/Activity', 'Keyword', 'MCC',
                                                     'Accuracy', 'Balanced Accuracy', 'F1', 'Items'])
         outfile = 'keyword_results-{}-{}.xlsx'.format(company, direction)
@@ -48,3 +168,6 @@ if __name__ == '__main__':
             worksheet.conditional_format('{}2:{}{}'.format(column, column, str(len(df_results.index) + 1)),
                                          {'type': '3_color_scale'})
         writer.save()
+        if args.preprocessed:
+            write_stage(classify_preprocessed(company, direction, mapping), os.path.join('data', 'keyword-classified'),
+                        'twcs-{}-{}-keywords'.format(company, direction))
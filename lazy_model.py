@@ -0,0 +1,32 @@
+import threading
+import time
+
+import instrumentation
+
+
+class LazyModel:
+
+    def __init__(self, load):
+        # load imports and builds the model, it is called once per process on first use
+        self.load = load
+        self.lock = threading.Lock()
+        self.model = None
+        self.loaded = False
+        self.load_time = None
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    start = time.perf_counter()
+                    self.model = self.load()
+                    self.load_time = time.perf_counter() - start
+                    instrumentation.record('model.' + self.load.__name__, self.load_time)
+                    self.loaded = True
+        return self.model
+
+    def warm_start(self):
+        # Loads the model in the background, e.g. while the input files are read, the next get waits for it to finish
+        thread = threading.Thread(target=self.get, daemon=True)
+        thread.start()
+        return thread
@@ -1,16 +1,27 @@
+import argparse
 import os
-import pickle
 from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
-import torch
-from transformers import pipeline
 
+import instrumentation
+from cache_store import NLICache
+from lazy_model import LazyModel
+from stage_io import find_stage_file, list_stage_files, read_stage, write_stage
 
-if torch.cuda.is_available():
-    classifier = pipeline('zero-shot-classification', device=0)
-else:
-    classifier = pipeline('zero-shot-classification')
+# The default model of the zero-shot-classification pipeline, named explicitly so that the NLI cache can be opened
+# without loading it
+model_name = 'facebook/bart-large-mnli'
+
+
+def load_classifier():
+    import torch
+    from transformers import pipeline
+    return pipeline('zero-shot-classification', model=model_name, device=0 if torch.cuda.is_available() else -1)
+
+
+classifier = LazyModel(load_classifier)
 
 
 thresholds = list(reversed([0.7 + x * 0.01 for x in range(0, 29)] + [0.98 + x * 0.001 for x in range(0, 20)]))
@@ -21,55 +32,117 @@ def parse_filename(filename):
     return company, tweets, direction
 
 
+def open_nlp_cache(path='nlp_cache.sqlite', legacy_path='nlp_cache.pkl'):
+    nlp_cache = NLICache(path, model_name)
+    if os.path.exists(legacy_path):
+        nlp_cache.migrate_pickle(legacy_path)
+    return nlp_cache
+
+
 def nlp(text, candidate_labels, nlp_cache, hypothesis_template="{}."):
     result_dict = OrderedDict.fromkeys(candidate_labels)
     for key in result_dict:
-        if text + '__' + key in nlp_cache:
-            result_dict[key] = nlp_cache[text + '__' + key]
+        result_dict[key] = nlp_cache.lookup(text, key, hypothesis_template)
     remaining_candidate_labels = [c for c in candidate_labels if result_dict[c] is None]
     if len(remaining_candidate_labels) > 0:
-        classified = classifier(text, remaining_candidate_labels, hypothesis_template=hypothesis_template,
-                                multi_class=True)
-        print(classified)
+        nli_pipeline = classifier.get()
+        with instrumentation.stage('nli.model', rows=len(remaining_candidate_labels)):
+            classified = nli_pipeline(text, remaining_candidate_labels, hypothesis_template=hypothesis_template,
+                                      multi_class=True)
         for key, value in zip(classified['labels'], classified['scores']):
             result_dict[key] = value
-            nlp_cache[text + '__' + key] = value
+            nlp_cache.store(text, key, value, hypothesis_template)
     return OrderedDict(('pred_' + k, v) for k, v in result_dict.items())
 
 
-def predict(df, df_nli_template, nlp_cache):
+def entailment_scores(pairs, hypothesis_template="{}.", batch_size=32):
+    # Same scores as the pipeline with multi_class=True, but for many (premise, label) pairs at once. Pairs are
+    # sorted by token length before batching so that each batch is padded to similar lengths only.
+    if len(pairs) == 0:
+        # All pairs were cached, so neither torch nor the model need to be loaded
+        return []
+    import torch
+    nli_pipeline = classifier.get()
+    with instrumentation.stage('nli.tokenize', rows=len(pairs)):
+        encodings = [nli_pipeline.tokenizer(premise, hypothesis_template.format(label), truncation='only_first')
+                     for premise, label in pairs]
+    order = sorted(range(len(encodings)), key=lambda i: len(encodings[i]['input_ids']))
+    entailment_id = nli_pipeline.entailment_id
+    contradiction_id = -1 if entailment_id == 0 else 0
+    scores = [None] * len(pairs)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        with instrumentation.stage('nli.model', rows=len(batch)):
+            inputs = nli_pipeline.tokenizer.pad([encodings[i] for i in batch], return_tensors='pt')
+            with torch.no_grad():
+                inputs = nli_pipeline.ensure_tensor_on_device(**inputs)
+                logits = nli_pipeline.model(**inputs)[0].cpu().numpy()
+        entail_contr_logits = logits[:, [contradiction_id, entailment_id]]
+        probabilities = np.exp(entail_contr_logits) / np.exp(entail_contr_logits).sum(-1, keepdims=True)
+        for i, probability in zip(batch, probabilities[:, 1]):
+            scores[i] = float(probability)
+    return scores
+
+
+def nlp_batch(texts, candidate_labels, nlp_cache, hypothesis_template="{}.", batch_size=32):
+    candidate_labels = list(OrderedDict.fromkeys(candidate_labels))
+    pairs = [(text, label) for text in OrderedDict.fromkeys(texts) for label in candidate_labels]
+    scores = nlp_cache.lookup_many(pairs, hypothesis_template)
+    pairs = [pair for pair in pairs if pair not in scores]
+    for pair, score in zip(pairs, entailment_scores(pairs, hypothesis_template, batch_size)):
+        scores[pair] = score
+        nlp_cache.store(pair[0], pair[1], score, hypothesis_template)
+    return pd.DataFrame([[scores[(text, label)] for label in candidate_labels] for text in texts],
+                        index=texts.index, columns=['pred_' + label for label in candidate_labels])
+
+
+def predict(df, df_nli_template, nlp_cache, batch_size=None):
     df = df.fillna(0)
     for header in list(df_nli_template):
         hypotheses = df_nli_template[header].dropna().values.tolist()
         if len(hypotheses) == 0:
             continue
         hypotheses_labels = ['pred_' + header + '_' + hypothesis for hypothesis in hypotheses]
-        df[[label for label in hypotheses_labels]] = df.text.apply(lambda x: pd.Series(nlp(x, hypotheses, nlp_cache)))
+        with instrumentation.stage('nli.predict', rows=len(df.index)):
+            if batch_size:
+                df[hypotheses_labels] = nlp_batch(df.text, hypotheses, nlp_cache, batch_size=batch_size).values
+            else:
+                df[[label for label in hypotheses_labels]] = df.text.apply(
+                    lambda x: pd.Series(nlp(x, hypotheses, nlp_cache)))
     return df
 
 
+def predict_file(filename, nlp_cache, batch_size=None):
+    company, tweets, direction = parse_filename(filename)
+    df = read_stage(os.path.join('data', 'labeled', filename), index_col=[0])
+    nli_template = 'twcs-{}-nli'.format(company)
+    df_nli_template = read_stage(find_stage_file(os.path.join('data', 'nli-templates', direction), nli_template))
+    df = predict(df, df_nli_template, nlp_cache, batch_size=batch_size)
+    outfile = 'twcs-{}-{}-{}-predicted'.format(company, tweets, direction)
+    return write_stage(df, os.path.join('data', 'predicted'), outfile)
+
+
 if __name__ == '__main__':
 
-    if not os.path.exists('nlp_cache.pkl'):
-        open('nlp_cache.pkl', 'wb+').close()
-    nlp_cache_stream = open('nlp_cache.pkl', 'rb')
-    try:
-        nlp_cache = pickle.load(nlp_cache_stream)
-    except EOFError:
-        nlp_cache = dict()
-    nlp_cache_stream.close()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int,
+                        help='Classify all uncached Tweets of a file in batches of this size instead of one by one.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='Load the NLI model in the background right away instead of on first use.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    if args.warm_start:
+        classifier.warm_start()
+
+    nlp_cache = open_nlp_cache()
 
     if not os.path.exists(os.path.join('data', 'predicted')):
         os.mkdir(os.path.join('data', 'predicted'))
 
-    for filename in os.listdir(os.path.join('data', 'labeled')):
-        company, tweets, direction = parse_filename(filename)
-        df = pd.read_excel(os.path.join('data', 'labeled', filename), index_col=[0])
-        nli_template = 'twcs-{}-nli.xlsx'.format(company)
-        df_nli_template = pd.read_excel(os.path.join('data', 'nli-templates', direction, nli_template))
-        df = predict(df, df_nli_template, nlp_cache)
-        outfile = 'twcs-{}-{}-{}-predicted.xlsx'.format(company, tweets, direction)
-        df.to_excel(os.path.join('data', 'predicted', outfile))
-
-    with open('nlp_cache.pkl', 'wb+') as outfile:
-        pickle.dump(nlp_cache, outfile)
+    for filename in list_stage_files(os.path.join('data', 'labeled')):
+        predict_file(filename, nlp_cache, batch_size=args.batch_size)
+
+    nlp_cache.close()
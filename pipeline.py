@@ -0,0 +1,280 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from stage_io import file_digest, find_stage_file, list_stage_files
+
+companies = ['AmazonHelp', 'AppleSupport', 'SpotifyCares']
+
+# A partition is the unit of work of a stage, e.g. one labeled file for the NLI. It is run again if the contents of
+# its inputs, which include the stage's own source files, or its parameters changed since it last ran.
+Partition = namedtuple('Partition', ['stage', 'name', 'inputs', 'parameters', 'run'])
+
+
+class PipelineContext:
+
+    def __init__(self, args):
+        self.args = args
+        self.nlp_cache = None
+        self.executor = None
+        self.digests = {}
+
+    def open_nlp_cache(self):
+        # Opened only once and only if a partition needs it, the NLI model itself is loaded on first use
+        if self.nlp_cache is None:
+            from nli import open_nlp_cache
+            self.nlp_cache = open_nlp_cache()
+        return self.nlp_cache
+
+    def open_executor(self):
+        if self.executor is None and self.args.jobs > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.args.jobs)
+        return self.executor
+
+    def file_digest(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            self.digests[key] = file_digest(path)
+        return self.digests[key]
+
+    def close(self):
+        if self.nlp_cache is not None:
+            self.nlp_cache.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def source_files(script):
+    # The script and every module of this repository it imports, directly or indirectly and also inside functions, so
+    # that editing any of them invalidates the partitions of the stage
+    sources = [script]
+    for path in sources:
+        with open(path) as stream:
+            tree = ast.parse(stream.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split('.')[0] + '.py'
+                if module not in sources and os.path.exists(module):
+                    sources.append(module)
+    return sources
+
+
+def split_filename(filename):
+    return filename.split('.')[0].split('-')
+
+
+def preprocessing_partitions(context):
+    def run():
+        from preprocessing import preprocess
+        return preprocess(companies, chunksize=context.args.chunksize, sample_frac=context.args.sample_frac,
+                          jobs=context.args.jobs)
+
+    yield Partition('preprocessing', 'twcs', ['twcs.csv'] + source_files('preprocessing.py'),
+                    {'companies': companies, 'chunksize': context.args.chunksize,
+                     'sample_frac': context.args.sample_frac}, run)
+
+
+def nli_partitions(context):
+    sources = source_files('nli.py')
+    for filename in list_stage_files(os.path.join('data', 'labeled')):
+        _, company, _, direction = split_filename(filename)
+        template_file = find_stage_file(os.path.join('data', 'nli-templates', direction), 'twcs-{}-nli'.format(company))
+
+        def run(filename=filename):
+            from nli import predict_file
+            os.makedirs(os.path.join('data', 'predicted'), exist_ok=True)
+            return [predict_file(filename, context.open_nlp_cache(), batch_size=context.args.batch_size)]
+
+        yield Partition('nli', filename, [os.path.join('data', 'labeled', filename), template_file] + sources, {}, run)
+
+
+def cross_validation_partitions(context):
+    sources = source_files('cross_validation.py')
+    for filename in list_stage_files(os.path.join('data', 'predicted')):
+        _, company, _, direction, _ = split_filename(filename)
+        template_file = find_stage_file(os.path.join('data', 'nli-templates', direction), 'twcs-{}-nli'.format(company))
+
+        def run(filename=filename):
+            from cross_validation import cross_validate_file, seed
+            os.makedirs(os.path.join('results', 'nli-cv'), exist_ok=True)
+            return [cross_validate_file(filename, executor=context.open_executor(), seed=seed)]
+
+        yield Partition('cross_validation', filename,
+                        [os.path.join('data', 'predicted', filename), template_file] + sources, {}, run)
+
+
+def event_log_construction_partitions(context):
+    mappings_path = os.path.join('data', 'topics-activities')
+    sources = source_files('event_log_construction.py')
+    for filename in [filename for filename in list_stage_files(os.path.join('data', 'preprocessed'))
+                     if filename.startswith('twcs')]:
+        company = split_filename(filename)[1]
+        conversations_file = os.path.join('data', 'preprocessed', filename)
+
+        def run(conversations_file=conversations_file):
+            from event_log_construction import construct_event_log
+            os.makedirs('xes', exist_ok=True)
+            return [construct_event_log(conversations_file, 'xes', context.open_nlp_cache(),
+                                        batch_size=context.args.batch_size, compress=context.args.compress)]
+
+        yield Partition('event_log_construction', filename,
+                        [conversations_file, find_stage_file(mappings_path, 'twcs-' + company + '-outbound-activities'),
+                         find_stage_file(mappings_path, 'twcs-' + company + '-inbound-topics')] + sources,
+                        {'compress': context.args.compress}, run)
+
+
+def process_mining_partitions(context):
+    filenames = sorted(os.listdir('xes')) if os.path.exists('xes') else []
+    sources = source_files('process_mining.py')
+    for filename in [filename for filename in filenames
+                     if filename.startswith('twcs') and filename.endswith(('.xes', '.xes.gz'))]:
+        xes_file = os.path.join('xes', filename)
+
+        def run(xes_file=xes_file):
+            from process_mining import job_output, run_discovery_jobs, xes_discovery_jobs
+            path = os.path.join('results', 'process-discovery')
+            os.makedirs(path, exist_ok=True)
+            jobs = xes_discovery_jobs(xes_file, path)
+            run_discovery_jobs(jobs, os.path.join(path, 'manifest.json'), executor=context.open_executor())
+            return [job_output(job) for job in jobs]
+
+        yield Partition('process_mining', filename, [xes_file] + sources, {}, run)
+
+
+# Stages in topological order, each with the stages whose outputs it reads
+stages = {
+    'preprocessing': ([], preprocessing_partitions),
+    'nli': ([], nli_partitions),
+    'cross_validation': (['nli'], cross_validation_partitions),
+    'event_log_construction': (['preprocessing'], event_log_construction_partitions),
+    'process_mining': (['event_log_construction'], process_mining_partitions),
+}
+
+
+def with_downstream(selected_stages):
+    # The selected stages and all stages that read their outputs, directly or indirectly
+    selected = set(selected_stages)
+    for stage, (dependencies, _) in stages.items():
+        if selected.intersection(dependencies):
+            selected.add(stage)
+    return [stage for stage in stages if stage in selected]
+
+
+def read_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def write_state(state, path):
+    with open(path + '.tmp', 'w') as stream:
+        json.dump(state, stream, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def partition_digest(partition, context):
+    inputs = [[path, context.file_digest(path)] for path in partition.inputs]
+    content = json.dumps([partition.stage, partition.name, partition.parameters, inputs], sort_keys=True)
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def is_up_to_date(entry, digest, context):
+    return entry is not None and entry['digest'] == digest and all(
+        os.path.exists(path) and context.file_digest(path) == output_digest
+        for path, output_digest in entry['outputs'].items())
+
+
+def run_partition(partition, state, context, force=False, dry_run=False):
+    key = '{}/{}'.format(partition.stage, partition.name)
+    missing = [path for path in partition.inputs if not os.path.exists(path)]
+    if missing:
+        print('{:<70} missing {}'.format(key, ', '.join(missing)))
+        return
+    digest = partition_digest(partition, context)
+    entry = state.get(key)
+    if not force and is_up_to_date(entry, digest, context):
+        print('{:<70} up to date'.format(key))
+        instrumentation.count('pipeline.partitions_up_to_date')
+        return
+    if dry_run:
+        print('{:<70} stale'.format(key))
+        return
+    instrumentation.count('pipeline.partitions_run')
+    start = time.perf_counter()
+    outputs = partition.run()
+    # Outputs of a previous run that the partition no longer writes
+    for path in entry['outputs'] if entry is not None else []:
+        if path not in outputs and os.path.exists(path):
+            os.remove(path)
+    state[key] = {'digest': digest, 'outputs': {path: context.file_digest(path) for path in outputs}}
+    elapsed = time.perf_counter() - start
+    instrumentation.record('pipeline.' + partition.stage, elapsed)
+    print('{:<70} {:.2f}s'.format(key, elapsed))
+
+
+def remove_orphans(stage, keys, state):
+    # Partitions of earlier runs whose inputs are gone, e.g. a preprocessed file with a different number of Tweets.
+    # Their outputs are removed unless a current partition wrote them as well.
+    orphans = [key for key in state if key.split('/', 1)[0] == stage and key not in keys]
+    current_outputs = {path for key in keys if key in state for path in state[key]['outputs']}
+    for key in orphans:
+        for path in state.pop(key)['outputs']:
+            if path not in current_outputs and os.path.exists(path):
+                os.remove(path)
+
+
+def run_pipeline(selected_stages, context, state_path='pipeline_state.json', force=False, dry_run=False):
+    # Runs the partitions whose inputs changed, stage by stage, so that the partitions of a stage see the outputs of
+    # the stages before. The state is saved after every partition, so an interrupted run resumes with the partitions
+    # that did not finish.
+    state = read_state(state_path)
+    for stage in with_downstream(selected_stages):
+        keys = set()
+        for partition in stages[stage][1](context):
+            keys.add('{}/{}'.format(partition.stage, partition.name))
+            run_partition(partition, state, context, force=force, dry_run=dry_run)
+            if not dry_run:
+                write_state(state, state_path)
+        if not dry_run:
+            remove_orphans(stage, keys, state)
+            write_state(state, state_path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', choices=list(stages), default=list(stages),
+                        help='Stages to run, together with the stages that depend on them (default: all).')
+    parser.add_argument('--force', action='store_true', help='Run all partitions, even if their inputs are unchanged.')
+    parser.add_argument('--dry-run', action='store_true', help='Only list which partitions would run.')
+    parser.add_argument('--state', default='pipeline_state.json',
+                        help='File to keep the digests of the inputs and outputs of each partition in.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes for the stages that support them.')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of Tweets and hypotheses per NLI batch.')
+    parser.add_argument('--chunksize', type=int, help='Read twcs.csv in chunks of this many rows.')
+    parser.add_argument('--sample-frac', type=float, help='Fraction of the filtered Tweets to keep.')
+    parser.add_argument('--compress', action='store_true', help='Write gzip-compressed .xes.gz files.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    context = PipelineContext(args)
+    try:
+        run_pipeline(args.stages, context, state_path=args.state, force=args.force, dry_run=args.dry_run)
+    finally:
+        context.close()
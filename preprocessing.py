@@ -1,35 +1,108 @@
+import argparse
 import csv
 import os
+from multiprocessing import Pool
 
-import fasttext
-import networkx as nx
+import numpy as np
 import pandas as pd
-from spellchecker import SpellChecker
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-spell = SpellChecker()
+import instrumentation
+from cache_store import SpellingCache
+from lazy_model import LazyModel
+from stage_io import write_stage
 
-model = fasttext.load_model('lid.176.ftz')
+spell_distance = 2
+
+
+def load_spell_checker():
+    from spellchecker import SpellChecker
+    return SpellChecker(distance=spell_distance)
+
+
+def load_language_model():
+    import fasttext
+    return fasttext.load_model('lid.176.ftz')
+
+
+spell = LazyModel(load_spell_checker)
+
+model = LazyModel(load_language_model)
+
+twcs_schema = pa.schema([('tweet_id', pa.int64()), ('author_id', pa.string()), ('inbound', pa.bool_()),
+                         ('created_at', pa.string()), ('text', pa.string()), ('response_tweet_id', pa.string()),
+                         ('in_response_to_tweet_id', pa.float64())])
+
+# Read with the same dtypes in both the chunked and the full read, so that both yield the same table
+twcs_dtypes = {'tweet_id': 'int64', 'author_id': str, 'inbound': bool, 'created_at': str, 'text': str,
+               'response_tweet_id': str, 'in_response_to_tweet_id': 'float64'}
 
 
 def filter_outbound_tweets_by_company(df, companies):
     return df[(df['inbound'] == True) | (df['author_id'].isin(companies))]
 
 
+def stream_outbound_tweets_by_company(path, companies, spill_path, chunksize=100000):
+    # Reads the CSV in chunks and spills the filtered chunks to a single Parquet file, so that at most one chunk of
+    # the unfiltered data is held in memory, and returns the number of spilled Tweets
+    chunks = pd.read_csv(path, quoting=csv.QUOTE_ALL, usecols=twcs_schema.names, chunksize=chunksize,
+                         dtype=twcs_dtypes)
+    with pq.ParquetWriter(spill_path, twcs_schema) as writer:
+        for df_chunk in chunks:
+            df_chunk['text'] = df_chunk['text'].str.replace('\n', ' ', regex=False)
+            df_chunk = filter_outbound_tweets_by_company(df_chunk, companies)
+            writer.write_table(pa.Table.from_pandas(df_chunk[twcs_schema.names], schema=twcs_schema,
+                                                    preserve_index=False))
+    return pq.ParquetFile(spill_path).metadata.num_rows
+
+
+def partition_conversations(spill_path, partition_path, chunksize=100000):
+    # Splits the spilled Tweets by their conversation into Parquet files of about chunksize Tweets each, so that the
+    # other steps, which all work per conversation, can process one file at a time. Only the IDs of all Tweets are
+    # held in memory at once, to find the conversation of each Tweet.
+    ids = pq.read_table(spill_path, columns=['tweet_id', 'in_response_to_tweet_id']).to_pandas()
+    main_tweet_ids = find_main_tweet_ids(ids['tweet_id'].values, ids['in_response_to_tweet_id'].values)
+    n_partitions = max(1, -(-len(main_tweet_ids) // chunksize))
+    partitions = main_tweet_ids % n_partitions
+    os.makedirs(partition_path, exist_ok=True)
+    paths = [os.path.join(partition_path, 'twcs-filtered-{}.parquet'.format(i)) for i in range(n_partitions)]
+    writers = [pq.ParquetWriter(path, twcs_schema) for path in paths]
+    start = 0
+    for batch in pq.ParquetFile(spill_path).iter_batches(batch_size=chunksize):
+        table = pa.Table.from_batches([batch])
+        batch_partitions = partitions[start:start + len(table)]
+        for partition in np.unique(batch_partitions):
+            writers[partition].write_table(table.filter(pa.array(batch_partitions == partition)))
+        start += len(table)
+    for writer in writers:
+        writer.close()
+    return paths
+
+
+def find_main_tweet_ids(tweet_ids, in_response_to_tweet_ids):
+    # Follows the reply chain of every Tweet up to its root by pointer jumping over integer-encoded IDs. The root
+    # can be a Tweet that is not part of the data itself.
+    has_parent = ~np.isnan(in_response_to_tweet_ids)
+    parent_ids = in_response_to_tweet_ids[has_parent].astype(np.int64)
+    ids, codes = np.unique(np.concatenate([np.asarray(tweet_ids, dtype=np.int64), parent_ids]), return_inverse=True)
+    tweet_codes = codes[:len(tweet_ids)]
+    parents = np.arange(len(ids))
+    parents[tweet_codes[has_parent]] = codes[len(tweet_ids):]
+    for _ in range(int(np.log2(max(len(ids), 1))) + 2):
+        grandparents = parents[parents]
+        if np.array_equal(grandparents, parents):
+            return ids[parents[tweet_codes]]
+        parents = grandparents
+    raise ValueError('The replies between the Tweets contain a cycle.')
+
+
 def add_main_tweet_id(df):
     df['created_at'] = pd.to_datetime(df['created_at'])
     df['created_at'] = df['created_at'].dt.tz_localize(None)
-    df_responses = df[df['in_response_to_tweet_id'].notnull()]
-    g = nx.from_pandas_edgelist(df_responses, source='in_response_to_tweet_id', target='tweet_id',
-                                create_using=nx.DiGraph)
-    roots = {n for n, d in g.in_degree() if d == 0}
-    d = {}
-    components = nx.weakly_connected_components(g)
-    for i, comp in enumerate(components):
-        comp_root = next(root for root in roots if root in comp)
-        d.update(dict.fromkeys(comp, comp_root))
-    df['main_tweet_id'] = df['tweet_id'].map(d)
-    df['main_tweet_id'].fillna(df['in_response_to_tweet_id'], inplace=True)
-    df['main_tweet_id'].fillna(df['tweet_id'], inplace=True)
+    # The IDs of the root Tweets used to come out of a float column and are kept as floats
+    df['main_tweet_id'] = find_main_tweet_ids(df['tweet_id'].values,
+                                              df['in_response_to_tweet_id'].values).astype(np.float64)
     df = df.sort_values(by=['main_tweet_id', 'created_at'])
     df = df[['main_tweet_id', 'tweet_id', 'in_response_to_tweet_id', 'response_tweet_id', 'created_at', 'author_id',
              'inbound', 'text']]
@@ -49,8 +122,32 @@ def remove_conversations_with_multiple_companies(df):
     return df.groupby(by=['main_tweet_id']).filter(lambda g: g.company.nunique() == 1)
 
 
-def remove_non_english_tweets(df):
-    return df[df.apply(lambda x: model.predict(str(x['text']).replace('\n', ''))[0][0] == '__label__en', axis=1)]
+def identify_languages(texts, batch_size=10000):
+    languages = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        language_model = model.get()
+        with instrumentation.stage('preprocessing.language_model', rows=len(batch)):
+            labels, _ = language_model.predict(batch)
+        languages.extend(label[0] for label in labels)
+    return languages
+
+
+def remove_non_english_tweets(df, batch_size=10000, jobs=1):
+    # Every distinct text is classified only once and the languages are joined back onto the Tweets
+    texts = df['text'].astype(str).str.replace('\n', '', regex=False)
+    unique_texts = texts.drop_duplicates().tolist()
+    if jobs > 1:
+        # Loaded before forking so that the processes share it instead of loading it each
+        model.get()
+        chunk_size = -(-len(unique_texts) // jobs)
+        with Pool(jobs) as pool:
+            chunks = pool.starmap(identify_languages, [(unique_texts[start:start + chunk_size], batch_size)
+                                                       for start in range(0, len(unique_texts), chunk_size)])
+        languages = [language for chunk in chunks for language in chunk]
+    else:
+        languages = identify_languages(unique_texts, batch_size)
+    return df[texts.map(pd.Series(languages, index=unique_texts)) == '__label__en']
 
 
 def remove_non_conversational_tweets(df):
@@ -58,41 +155,139 @@ def remove_non_conversational_tweets(df):
 
 
 def correct_spellings(text):
-    corrected_text = []
-    misspelled_words = spell.unknown(text.split())
-    for word in text.split():
-        if word in misspelled_words:
-            corrected_text.append(spell.correction(word))
+    spell_checker = spell.get()
+    words = text.split()
+    misspelled_words = spell_checker.unknown(words)
+    return " ".join(spell_checker.correction(word) if word in misspelled_words else word for word in words)
+
+
+def correct_word(word):
+    return spell.get().correction(word)
+
+
+def find_corrections(words, spelling_cache, jobs=1):
+    # SpellChecker.unknown returns lowercased words, so only words that are misspelled and lowercase already are
+    # corrected, exactly like in correct_spellings
+    unknown_words = spell.get().unknown(words)
+    misspelled_words = [word for word in words if word in unknown_words]
+    corrections = spelling_cache.lookup_many(misspelled_words)
+    remaining_words = [word for word in misspelled_words if word not in corrections]
+    with instrumentation.stage('preprocessing.spell_checker', rows=len(remaining_words)):
+        if jobs > 1:
+            with Pool(jobs) as pool:
+                corrected_words = pool.map(correct_word, remaining_words, chunksize=64)
         else:
-            corrected_text.append(word)
-    return " ".join(corrected_text)
+            corrected_words = [correct_word(word) for word in remaining_words]
+    for word, corrected_word in zip(remaining_words, corrected_words):
+        corrections[word] = corrected_word
+        spelling_cache.store(word, corrected_word)
+    spelling_cache.flush()
+    return corrections
 
 
-def correct_spellings_inbound(df):
-    df['text'] = df.apply(lambda x: correct_spellings(x['text']) if x['inbound'] == True else x['text'], axis=1)
+def correct_spellings_inbound(df, spelling_cache, jobs=1):
+    inbound = (df['inbound'] == True).values
+    words = pd.Series(df.loc[inbound, 'text'].values).str.split().explode().dropna()
+    corrections = find_corrections(words.unique().tolist(), spelling_cache, jobs)
+    corrected_words = words.map(corrections).fillna(words)
+    corrected_texts = corrected_words.groupby(level=0, sort=False).agg(' '.join)
+    df.loc[inbound, 'text'] = corrected_texts.reindex(range(inbound.sum()), fill_value='').values
     return df
 
 
-if __name__ == '__main__':
-    companies = ['AmazonHelp', 'AppleSupport', 'SpotifyCares']
-    df = pd.read_csv('twcs.csv', quoting=csv.QUOTE_ALL)
-    df = df.replace('\n', ' ', regex=True)
-    df = filter_outbound_tweets_by_company(df, companies)
-    df = df.sample(frac=0.02)
-    df = add_main_tweet_id(df)
-    df = add_company(df)
-    df = remove_conversations_with_multiple_companies(df)
-    df = remove_non_english_tweets(df)
-    df = remove_non_conversational_tweets(df)
-    df = correct_spellings_inbound(df)
+def open_spelling_cache(path='spelling_cache.sqlite'):
+    return SpellingCache(path, 'en-{}'.format(spell_distance))
+
 
+def preprocess_tweets(df, spelling_cache, jobs=1):
+    with instrumentation.stage('preprocessing.add_main_tweet_id', rows=len(df.index)):
+        df = add_main_tweet_id(df)
+    with instrumentation.stage('preprocessing.add_company', rows=len(df.index)):
+        df = add_company(df)
+    with instrumentation.stage('preprocessing.remove_conversations_with_multiple_companies', rows=len(df.index)):
+        df = remove_conversations_with_multiple_companies(df)
+    with instrumentation.stage('preprocessing.remove_non_english_tweets', rows=len(df.index)):
+        df = remove_non_english_tweets(df, jobs=jobs)
+    with instrumentation.stage('preprocessing.remove_non_conversational_tweets', rows=len(df.index)):
+        df = remove_non_conversational_tweets(df)
+    with instrumentation.stage('preprocessing.correct_spellings_inbound', rows=len(df.index)):
+        df = correct_spellings_inbound(df, spelling_cache, jobs=jobs)
+    return df
+
+
+def preprocess(companies, chunksize=None, sample_frac=None, jobs=1):
     if not os.path.exists('data'):
         os.mkdir('data')
 
+    if sample_frac is None:
+        sample_frac = 1.0 if chunksize else 0.02
+    spelling_cache = open_spelling_cache()
+    if chunksize:
+        spill_path = os.path.join('data', 'twcs-filtered.parquet')
+        partition_path = os.path.join('data', 'twcs-filtered')
+        with instrumentation.stage('preprocessing.read') as timer:
+            tweets = stream_outbound_tweets_by_company('twcs.csv', companies, spill_path, chunksize=chunksize)
+            timer.rows = tweets
+        with instrumentation.stage('preprocessing.partition_conversations', rows=tweets):
+            partition_paths = partition_conversations(spill_path, partition_path, chunksize)
+        # Only one partition of the filtered Tweets is held in memory at a time, besides the preprocessed Tweets
+        preprocessed = []
+        for path in partition_paths:
+            df = pd.read_parquet(path)
+            os.remove(path)
+            if sample_frac < 1.0:
+                df = df.sample(frac=sample_frac)
+            if len(df.index) > 0:
+                preprocessed.append(preprocess_tweets(df, spelling_cache, jobs=jobs))
+        os.rmdir(partition_path)
+        df = pd.concat(preprocessed, ignore_index=True)
+    else:
+        with instrumentation.stage('preprocessing.read') as timer:
+            df = pd.read_csv('twcs.csv', quoting=csv.QUOTE_ALL, dtype=twcs_dtypes)
+            df = df.replace('\n', ' ', regex=True)
+            df = filter_outbound_tweets_by_company(df, companies)
+            timer.rows = len(df.index)
+        if sample_frac < 1.0:
+            df = df.sample(frac=sample_frac)
+        df = preprocess_tweets(df, spelling_cache, jobs=jobs)
+    spelling_cache.close()
+    # Both paths yield the Tweets in the same order and with a fresh index. Tweets of a conversation created at the
+    # same time are ordered by their ID, since the chunked path preprocesses them in a different order.
+    df = df.sort_values(by=['main_tweet_id', 'created_at', 'tweet_id']).reset_index(drop=True)
+
     if not os.path.exists(os.path.join('data', 'preprocessed')):
         os.mkdir(os.path.join('data', 'preprocessed'))
 
+    paths = []
     for company in companies:
         df_company = df[df['company'] == company]
-        filename = 'twcs-{}-preprocessed-{}.xlsx'.format(company, str(len(df_company.index)))
-        df_company.to_excel(os.path.join('data', 'preprocessed', filename))
+        name = 'twcs-{}-preprocessed-{}'.format(company, str(len(df_company.index)))
+        paths.append(write_stage(df_company, os.path.join('data', 'preprocessed'), name))
+    return paths
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunksize', type=int,
+                        help='Read twcs.csv in chunks of this many rows, spill the filtered chunks to Parquet, and '
+                             'preprocess them in partitions of about as many Tweets.')
+    parser.add_argument('--sample-frac', type=float,
+                        help='Fraction of the filtered Tweets to keep (default: 0.02, or 1.0 with --chunksize).')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes for language identification and spelling correction.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='Load the language identification model and the spell checker in the background right '
+                             'away instead of on first use.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    if args.warm_start:
+        model.warm_start()
+        spell.warm_start()
+
+    companies = ['AmazonHelp', 'AppleSupport', 'SpotifyCares']
+
+    preprocess(companies, chunksize=args.chunksize, sample_frac=args.sample_frac, jobs=args.jobs)
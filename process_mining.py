@@ -1,17 +1,31 @@
+import argparse
+import hashlib
+import json
 import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from pm4py.algo.discovery.alpha import algorithm as alpha_miner
-from pm4py.algo.discovery.dfg import algorithm as dfg_discovery
-from pm4py.algo.discovery.heuristics import algorithm as heuristics_miner
+import numpy as np
+from pm4py.algo.conformance.tokenreplay import algorithm as token_replay
+from pm4py.algo.discovery.alpha.variants import classic as alpha_miner
+from pm4py.algo.discovery.heuristics.variants import classic as heuristics_miner
 from pm4py.algo.discovery.inductive import algorithm as inductive_miner
-from pm4py.algo.filtering.log.attributes import attributes_filter
-from pm4py.algo.filtering.log.start_activities import start_activities_filter
-from pm4py.algo.filtering.log.variants import variants_filter
-from pm4py.objects.log.importer.xes import importer as xes_importer
-from pm4py.statistics.traces.log import case_statistics
+from pm4py.algo.discovery.inductive.variants.im_d import dfg_based as inductive_miner_dfg
+from pm4py.objects.conversion.heuristics_net import converter as heuristics_net_converter
+from pm4py.objects.log.log import Event, EventLog, Trace
+from pm4py.objects.petri import performance_map
 from pm4py.visualization.dfg import visualizer as dfg_visualization
 from pm4py.visualization.petrinet import visualizer as pn_visualizer
 
+import instrumentation
+from variant_index import VariantIndex, directly_follows, frequency_triples
+from xes_io import load_xes
+
+
+filters = ['variants_percentage_1.0', 'variants_top_5', 'variants_top_6', 'variants_top_7', 'variants_top_8',
+           'variants_top_9', 'variants_top_10', 'variants_top_15']
+
 
 def parse_filename(filename):
     _, company, tweets = filename.split('.')[0].split('-')
@@ -21,92 +35,250 @@ def parse_filename(filename):
 def parse_variants_filter_arg(variants_filter_name):
     if variants_filter_name.startswith('variants_percentage'):
         percentage = variants_filter_name.split('_')[-1]
-        return lambda x: variants_filter.filter_log_variants_percentage(x, percentage=float(percentage))
+        return lambda x: x.percentage(float(percentage))
     elif variants_filter_name.startswith('variants_auto'):
         percentage = variants_filter_name.split('_')[-1]
-        return lambda x: variants_filter.apply_auto_filter(
-            x, parameters={attributes_filter.Parameters.DECREASING_FACTOR: float(percentage)})
+        return lambda x: x.auto(float(percentage))
     elif variants_filter_name.startswith('variants_top'):
         k = variants_filter_name.split('_')[-1]
-        return lambda x: variants_filter.filter_variants_top_k(x, int(k))
+        return lambda x: x.top_k(int(k))
+
+
+def filter_classified_start_activities(events, company):
+    # Keeps the cases whose first event has an activity that starts a case once the company's own events are removed
+    cases = events['case:concept:name'].cat.codes.values
+    activities = events['concept:name'].cat.codes.values
+    customer = ~events['org:resource'].isin([company]).values
+    _, first_customer_events = np.unique(cases[customer], return_index=True)
+    topics = np.unique(activities[customer][first_customer_events])
+    case_ids, first_events = np.unique(cases, return_index=True)
+    classified_cases = case_ids[np.isin(activities[first_events], topics)]
+    return events[np.isin(cases, classified_cases)].reset_index(drop=True)
+
+
+def variants_to_log(variant_index):
+    # One trace per variant, which is all the miners and the token replay need
+    log = EventLog()
+    for variant in variant_index.counts:
+        log.append(Trace([Event({'concept:name': activity}) for activity in variant]))
+    return log
+
+
+def frequency_decorations(variant_index, net, initial_marking, final_marking):
+    # Replays one trace per variant and weights its statistics by the number of cases, as PM4Py's frequency
+    # decoration does for the variants of a full log
+    log = variants_to_log(variant_index)
+    aligned_traces = token_replay.apply(log, net, initial_marking, final_marking)
+    variants_idx = {','.join(variant): [i] * count for i, (variant, count) in enumerate(variant_index.counts.items())}
+    element_statistics = performance_map.single_element_statistics(log, net, initial_marking, aligned_traces,
+                                                                   variants_idx)
+    return performance_map.aggregate_statistics(element_statistics, measure='frequency')
 
 
-def filter_classified_start_activities(log, company):
-    tracefilter_log_neg = attributes_filter.apply_events(log, [company],
-                                                         parameters={
-                                                             attributes_filter.Parameters.ATTRIBUTE_KEY: "org:resource",
-                                                             attributes_filter.Parameters.POSITIVE: False})
-    topics = start_activities_filter.get_start_activities(tracefilter_log_neg).keys()
-    return start_activities_filter.apply(log, topics)
+def save_petri_net(variant_index, net, initial_marking, final_marking, path):
+    gviz = pn_visualizer.apply(net, initial_marking, final_marking, variant=pn_visualizer.Variants.FREQUENCY,
+                               aggregated_statistics=frequency_decorations(variant_index, net, initial_marking,
+                                                                           final_marking))
+    pn_visualizer.save(gviz, path)
 
 
-def print_variants_count(log):
-    variants_count = case_statistics.get_variant_statistics(log)
-    print(sorted(variants_count, key=lambda x: x['count'], reverse=True))
+def print_variants_count(variant_index):
+    print([{'variant': ','.join(variant), 'count': variant_index.counts[variant]}
+           for variant in variant_index.sorted_by_count()])
 
 
-def apply_alpha_miner(log, path, filename):
-    net, initial_marking, final_marking = alpha_miner.apply(log)
-    gviz = pn_visualizer.apply(net, initial_marking, final_marking, variant=pn_visualizer.Variants.FREQUENCY, log=log)
-    pn_visualizer.save(gviz, os.path.join(path, filename.format(algorithm='alpha_miner')))
+def apply_alpha_miner(variant_index, path, filename):
+    net, initial_marking, final_marking = alpha_miner.apply_dfg_sa_ea(
+        dict(variant_index.dfg), set(variant_index.start_activities), set(variant_index.end_activities))
+    save_petri_net(variant_index, net, initial_marking, final_marking,
+                   os.path.join(path, filename.format(algorithm='alpha_miner')))
 
 
-def apply_heuristics_miner(log, path, filename):
-    net, initial_marking, final_marking = heuristics_miner.apply(log)
-    gviz = pn_visualizer.apply(net, initial_marking, final_marking, variant=pn_visualizer.Variants.FREQUENCY, log=log)
-    pn_visualizer.save(gviz, os.path.join(path, filename.format(algorithm='heuristics_miner')))
+def apply_heuristics_miner(variant_index, path, filename):
+    heuristics_net = heuristics_miner.apply_heu_dfg(variant_index.dfg,
+                                                    activities=list(variant_index.activities),
+                                                    activities_occurrences=variant_index.activities,
+                                                    start_activities=variant_index.start_activities,
+                                                    end_activities=variant_index.end_activities,
+                                                    dfg_window_2=directly_follows(variant_index.counts, window=2),
+                                                    freq_triples=frequency_triples(variant_index.counts))
+    net, initial_marking, final_marking = heuristics_net_converter.apply(heuristics_net)
+    save_petri_net(variant_index, net, initial_marking, final_marking,
+                   os.path.join(path, filename.format(algorithm='heuristics_miner')))
 
 
-def apply_inductive_miner(log, path, filename):
-    net, initial_marking, final_marking = inductive_miner.apply(log)
-    gviz = pn_visualizer.apply(net, initial_marking, final_marking, variant=pn_visualizer.Variants.FREQUENCY, log=log)
-    pn_visualizer.save(gviz, os.path.join(path, filename.format(algorithm='inductive_miner')))
+def apply_inductive_miner(variant_index, path, filename):
+    variants = {','.join(variant): count for variant, count in variant_index.counts.items()}
+    net, initial_marking, final_marking = inductive_miner.apply_variants(variants)
+    save_petri_net(variant_index, net, initial_marking, final_marking,
+                   os.path.join(path, filename.format(algorithm='inductive_miner')))
 
 
-def apply_inductive_miner_imf(log, path, filename):
-    net, initial_marking, final_marking = inductive_miner.apply(log, variant=inductive_miner.Variants.IMf)
-    gviz = pn_visualizer.apply(net, initial_marking, final_marking, variant=pn_visualizer.Variants.FREQUENCY, log=log)
-    pn_visualizer.save(gviz, os.path.join(path, filename.format(algorithm='inductive_miner_infrequent')))
+def apply_inductive_miner_imf(variant_index, path, filename):
+    variants = {','.join(variant): count for variant, count in variant_index.counts.items()}
+    net, initial_marking, final_marking = inductive_miner.apply_variants(variants, variant=inductive_miner.Variants.IMf)
+    save_petri_net(variant_index, net, initial_marking, final_marking,
+                   os.path.join(path, filename.format(algorithm='inductive_miner_infrequent')))
 
 
-def apply_inductive_miner_imd(log, path, filename):
-    net, initial_marking, final_marking = inductive_miner.apply(log, variant=inductive_miner.Variants.IMd)
-    gviz = pn_visualizer.apply(net, initial_marking, final_marking, variant=pn_visualizer.Variants.FREQUENCY, log=log)
-    pn_visualizer.save(gviz, os.path.join(path, filename.format(algorithm='inductive_miner_dfg')))
+def apply_inductive_miner_imd(variant_index, path, filename):
+    net, initial_marking, final_marking = inductive_miner_dfg.apply_dfg(list(variant_index.dfg.items()),
+                                                                        activities=variant_index.activities,
+                                                                        start_activities=variant_index.start_activities,
+                                                                        end_activities=variant_index.end_activities)
+    save_petri_net(variant_index, net, initial_marking, final_marking,
+                   os.path.join(path, filename.format(algorithm='inductive_miner_dfg')))
 
 
-def apply_directly_follows_graph(log, path, filename):
-    dfg = dfg_discovery.apply(log)
-    gviz = dfg_visualization.apply(dfg, log=log, variant=dfg_visualization.Variants.FREQUENCY)
+def apply_directly_follows_graph(variant_index, path, filename):
+    gviz = dfg_visualization.apply(variant_index.dfg, activities_count=variant_index.activities,
+                                   soj_time={activity: 0.0 for activity in variant_index.activities},
+                                   variant=dfg_visualization.Variants.FREQUENCY)
     dfg_visualization.save(gviz, os.path.join(path, filename.format(algorithm='directly_follows_graph')))
 
 
-def process_discovery(log, path, filename):
-    print_variants_count(log)
-    apply_alpha_miner(log, path, filename)
-    apply_heuristics_miner(log, path, filename)
-    apply_inductive_miner(log, path, filename)
-    apply_inductive_miner_imf(log, path, filename)
-    apply_inductive_miner_imd(log, path, filename)
-    apply_directly_follows_graph(log, path, filename)
+algorithms = {
+    'alpha_miner': apply_alpha_miner,
+    'heuristics_miner': apply_heuristics_miner,
+    'inductive_miner': apply_inductive_miner,
+    'inductive_miner_infrequent': apply_inductive_miner_imf,
+    'inductive_miner_dfg': apply_inductive_miner_imd,
+    'directly_follows_graph': apply_directly_follows_graph,
+}
+
+
+def discovery_jobs(variant_index, path, filename):
+    return [(algorithm, variant_index, path, filename) for algorithm in algorithms]
+
+
+def xes_discovery_jobs(xes_file, path, use_cache=True):
+    with instrumentation.stage('process_mining.load_xes') as timer:
+        events = load_xes(xes_file, use_cache=use_cache)
+        timer.rows = len(events.index)
+    company, _ = parse_filename(os.path.basename(xes_file))
+    with instrumentation.stage('process_mining.variant_index', rows=len(events.index)):
+        variant_index = VariantIndex.from_events(filter_classified_start_activities(events, company))
+    jobs = []
+    for variants_filter_name in filters:
+        filter = parse_variants_filter_arg(variants_filter_name)
+        filtered_variant_index = filter(variant_index)
+        print_variants_count(filtered_variant_index)
+        process_discovery_filename = \
+            '{company}-{variants_filter}-{{algorithm}}.png'.format(company=company,
+                                                                   variants_filter=variants_filter_name)
+        jobs += discovery_jobs(filtered_variant_index, path, process_discovery_filename)
+    return jobs
+
+
+def job_digest(job):
+    # Content hash of an algorithm's input, the filtered variants with their counts regardless of their order
+    algorithm, variant_index, _, _ = job
+    variants = sorted([list(variant), count] for variant, count in variant_index.counts.items())
+    return hashlib.blake2b(json.dumps([algorithm, variants]).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def job_output(job):
+    algorithm, _, path, filename = job
+    return os.path.join(path, filename.format(algorithm=algorithm))
+
+
+def run_discovery_job(job):
+    start = time.perf_counter()
+    algorithm, variant_index, path, filename = job
+    algorithms[algorithm](variant_index, path, filename)
+    return time.perf_counter() - start
+
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def write_manifest(manifest, path):
+    with open(path + '.tmp', 'w') as stream:
+        json.dump(manifest, stream, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def run_discovery_jobs(jobs, manifest_path, executor=None):
+    # Skips the jobs whose output exists and was produced from the same input, and runs the jobs with the same input
+    # only once, copying their output. The manifest is updated after every job, so an interrupted run resumes.
+    manifest = read_manifest(manifest_path)
+    timings = {}
+    pending = {}
+
+    def key(job):
+        return os.path.relpath(job_output(job), os.path.dirname(manifest_path))
+
+    for job in jobs:
+        output, digest = job_output(job), job_digest(job)
+        if manifest.get(key(job)) == digest and os.path.exists(output):
+            timings[output] = 'unchanged'
+            instrumentation.count('process_mining.unchanged')
+        else:
+            pending.setdefault(digest, []).append(job)
+
+    def complete(digest, elapsed):
+        first, *duplicates = pending[digest]
+        timings[job_output(first)] = elapsed
+        # Measured in the process that ran the job, which may be a worker of the executor
+        instrumentation.record('process_mining.' + first[0], elapsed)
+        manifest[key(first)] = digest
+        for job in duplicates:
+            shutil.copyfile(job_output(first), job_output(job))
+            timings[job_output(job)] = 'copied'
+            instrumentation.count('process_mining.copied')
+            manifest[key(job)] = digest
+        write_manifest(manifest, manifest_path)
+
+    if executor is None:
+        for digest, (job, *_) in pending.items():
+            complete(digest, run_discovery_job(job))
+    else:
+        futures = {executor.submit(run_discovery_job, job): digest for digest, (job, *_) in pending.items()}
+        for future in as_completed(futures):
+            complete(futures[future], future.result())
+    return timings
 
 
 if __name__ == '__main__':
 
-    filters = ['variants_percentage_1.0', 'variants_top_5', 'variants_top_6', 'variants_top_7', 'variants_top_8',
-               'variants_top_9', 'variants_top_10', 'variants_top_15']
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Parse the XES files again instead of reading the cached event tables')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes to discover and render the process models with.')
+    parser.add_argument('--force', action='store_true',
+                        help='Discover all process models again, even if their input is unchanged')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
 
     if not os.path.exists(os.path.join('results', 'process-discovery')):
         os.mkdir(os.path.join('results', 'process-discovery'))
 
-    for filename in [filename for filename in os.listdir('xes') if filename.startswith('twcs')]:
-        log = xes_importer.apply(os.path.join('xes', filename))
-        company, _ = parse_filename(filename)
-        log = filter_classified_start_activities(log, company)
-        for variants_filter_name in filters:
-            filter = parse_variants_filter_arg(variants_filter_name)
-            filtered_log = filter(log)
-            process_discovery_filename = \
-                '{company}-{variants_filter}-{{algorithm}}.png'.format(company=company,
-                                                                       variants_filter=variants_filter_name)
-            process_discovery(filtered_log, os.path.join('results', 'process-discovery'), process_discovery_filename)
+    manifest_path = os.path.join('results', 'process-discovery', 'manifest.json')
+    if args.force and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    jobs = []
+    for filename in [filename for filename in sorted(os.listdir('xes'))
+                     if filename.startswith('twcs') and filename.endswith(('.xes', '.xes.gz'))]:
+        jobs += xes_discovery_jobs(os.path.join('xes', filename), os.path.join('results', 'process-discovery'),
+                                   use_cache=not args.no_cache)
+
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    timings = run_discovery_jobs(jobs, manifest_path, executor=executor)
+    if executor is not None:
+        executor.shutdown()
+
+    for output in sorted(timings):
+        timing = timings[output]
+        print('{:<80} {:>10}'.format(os.path.basename(output),
+                                     '{:.2f}s'.format(timing) if isinstance(timing, float) else timing))
+    discovered = sum(isinstance(timing, float) for timing in timings.values())
+    print('{} jobs, {} discovered in {:.2f}s'.format(len(jobs), discovered, time.perf_counter() - start))
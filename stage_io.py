@@ -0,0 +1,112 @@
+import hashlib
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+default_format = os.environ.get('STAGE_FORMAT', 'parquet')
+
+
+def normalize_object_columns(df):
+    # Parquet and Feather require a single type per column, so object columns that mix strings with other values,
+    # e.g. Tweet IDs next to NaN filled with 0, are stored as strings
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        values = df[column]
+        mixed = values.notnull() & ~values.map(lambda value: isinstance(value, str))
+        if mixed.any() and not mixed.all():
+            df.loc[mixed, column] = values[mixed].astype(str)
+    return df
+
+
+def index_columns(schema):
+    # The columns that hold the pandas index, which a projection has to read as well to keep the index. A RangeIndex
+    # is only stored in the metadata.
+    metadata = schema.pandas_metadata or {}
+    return [column for column in metadata.get('index_columns', []) if isinstance(column, str)]
+
+
+def read_parquet(path, columns=None, memory_map=False, **_):
+    return pq.read_table(path, columns=columns, memory_map=memory_map, use_pandas_metadata=True).to_pandas()
+
+
+def write_parquet(df, path):
+    pq.write_table(pa.Table.from_pandas(normalize_object_columns(df)), path)
+
+
+def read_feather(path, columns=None, memory_map=False, **_):
+    if columns is not None:
+        with pa.memory_map(path) as source:
+            columns = list(columns) + index_columns(pa.ipc.open_file(source).schema)
+    return feather.read_table(path, columns=columns, memory_map=memory_map).to_pandas()
+
+
+def write_feather(df, path):
+    feather.write_feather(pa.Table.from_pandas(normalize_object_columns(df)), path)
+
+
+def read_excel(path, columns=None, memory_map=False, **kwargs):
+    df = pd.read_excel(path, **kwargs)
+    return df if columns is None else df[columns]
+
+
+def write_excel(df, path):
+    df.to_excel(path)
+
+
+formats = {
+    'parquet': ('.parquet', read_parquet, write_parquet),
+    'feather': ('.feather', read_feather, write_feather),
+    'xlsx': ('.xlsx', read_excel, write_excel),
+}
+
+
+def stage_format(path):
+    extension = os.path.splitext(path)[1]
+    for name, (format_extension, _, _) in formats.items():
+        if extension == format_extension:
+            return name
+    raise ValueError('Unsupported stage file: {}'.format(path))
+
+
+def read_stage(path, columns=None, memory_map=False, **excel_kwargs):
+    # excel_kwargs such as index_col only apply to Excel files, the columnar formats keep the index themselves
+    _, read, _ = formats[stage_format(path)]
+    return read(path, columns=columns, memory_map=memory_map, **excel_kwargs)
+
+
+def write_stage(df, directory, name, format=None):
+    extension, _, write = formats[format or default_format]
+    path = os.path.join(directory, name + extension)
+    write(df, path)
+    return path
+
+
+def list_stage_files(directory):
+    # One file per stage name, preferring the default format if a stage exists in several formats
+    preference = [default_format] + [name for name in formats if name != default_format]
+    rank = {formats[name][0]: i for i, name in enumerate(preference)}
+    stage_files = {}
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        if extension in rank and (name not in stage_files
+                                  or rank[extension] < rank[os.path.splitext(stage_files[name])[1]]):
+            stage_files[name] = filename
+    return [stage_files[name] for name in sorted(stage_files)]
+
+
+def find_stage_file(directory, name):
+    for filename in list_stage_files(directory):
+        if os.path.splitext(filename)[0] == name:
+            return os.path.join(directory, filename)
+    raise FileNotFoundError('No stage file named {} in {}'.format(name, directory))
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
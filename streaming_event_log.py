@@ -0,0 +1,367 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter, OrderedDict
+
+import pandas as pd
+
+import instrumentation
+import preprocessing
+from event_log_construction import classify_tweets, compile_mappings, unescape_twitter_entities
+from nli import classifier, open_nlp_cache
+from stage_io import find_stage_file, read_stage
+
+event_columns = ['case:concept:name', 'tweet_id', 'time:timestamp', 'org:resource', 'text', 'company', 'concept:name']
+
+
+def follow_lines(stream, follow=False, poll_interval=1.0):
+    # Yields the complete lines of the stream and None whenever its end is reached. If follow, it keeps waiting for
+    # lines appended to the stream like tail -f, otherwise it stops at the end.
+    partial_line = ''
+    while True:
+        line = stream.readline()
+        if line == '':
+            if not follow:
+                if partial_line:
+                    yield partial_line
+                yield None
+                return
+            yield None
+            time.sleep(poll_interval)
+            continue
+        partial_line += line
+        if partial_line.endswith('\n'):
+            yield partial_line
+            partial_line = ''
+
+
+def read_records(lines, format='csv'):
+    # One dict per Tweet with the columns of twcs.csv, None passes on that the source is idle. A CSV record spans
+    # several lines as long as a quoted text contains line breaks, i.e. an odd number of quotes was read.
+    header = None
+    record = ''
+    for line in lines:
+        if line is None:
+            yield None
+        elif format == 'jsonl':
+            if line.strip():
+                yield json.loads(line)
+        else:
+            record += line
+            if record.count('"') % 2 == 1:
+                continue
+            row = next(csv.reader([record]))
+            record = ''
+            if header is None:
+                header = row
+            else:
+                yield dict(zip(header, row))
+
+
+def read_batches(records, max_size=256):
+    # Groups the records into batches of at most max_size, a batch is also passed on when the source is idle
+    batch = []
+    for record in records:
+        if record is not None:
+            batch.append(record)
+        if len(batch) > 0 and (record is None or len(batch) >= max_size):
+            yield batch
+            batch = []
+
+
+def parse_tweet_id(value):
+    if value is None or value == '' or (isinstance(value, float) and value != value):
+        return None
+    return int(float(value))
+
+
+def parse_tweets(records, companies):
+    # Like the preprocessing, only the inbound Tweets and the Tweets of the companies are kept
+    tweets = []
+    for record in records:
+        inbound = record['inbound']
+        inbound = inbound if isinstance(inbound, bool) else str(inbound) == 'True'
+        if inbound or str(record['author_id']) in companies:
+            tweets.append({
+                'tweet_id': parse_tweet_id(record['tweet_id']),
+                'parent_id': parse_tweet_id(record.get('in_response_to_tweet_id')),
+                'author_id': str(record['author_id']),
+                'created_at': record['created_at'],
+                'text': str(record['text']).replace('\n', ' '),
+                'english': None,
+                'names': None,
+            })
+    created_at = pd.to_datetime(pd.Series([tweet['created_at'] for tweet in tweets], dtype=object))
+    if len(tweets) > 0 and created_at.dt.tz is not None:
+        created_at = created_at.dt.tz_localize(None)
+    for tweet, timestamp in zip(tweets, created_at):
+        tweet['created_at'] = timestamp
+    return tweets
+
+
+def update_counts(counts, items, sign):
+    for item, count in items.items():
+        counts[item] += sign * count
+        if counts[item] == 0:
+            del counts[item]
+
+
+class StreamingEventLog:
+
+    def __init__(self, companies, mappings, nlp_cache, spelling_cache, output_path, batch_size=32,
+                 close_after=pd.Timedelta(days=1), max_open=100000):
+        # mappings holds the compiled activity and topic mappings of each company
+        self.companies = companies
+        self.mappings = mappings
+        self.nlp_cache = nlp_cache
+        self.spelling_cache = spelling_cache
+        self.output_path = output_path
+        self.batch_size = batch_size
+        self.close_after = close_after
+        self.max_open = max_open
+        # The root of every Tweet in an open conversation, which is the ID of the opening Tweet, or the ID of the
+        # Tweet it replies to if that is unknown, like in add_main_tweet_id
+        self.roots = {}
+        # The open conversations by their root, the least recently updated first
+        self.conversations = OrderedDict()
+        self.models = {company: {'cases': 0, 'activities': Counter(), 'start_activities': Counter(),
+                                 'end_activities': Counter(), 'dfg': Counter()} for company in companies}
+        self.watermark = None
+        # Events of the closed conversations that are not written yet, by company
+        self.closed_events = {company: [] for company in companies}
+        self.closed = 0
+        self.events = 0
+
+    def thread(self, tweet):
+        root = self.roots.get(tweet['parent_id'], tweet['parent_id']) if tweet['parent_id'] is not None \
+            else tweet['tweet_id']
+        self.roots[tweet['tweet_id']] = root
+        if root not in self.conversations:
+            self.conversations[root] = {'tweets': [], 'companies': set(), 'updated_at': tweet['created_at'],
+                                        'company': None, 'trace': ()}
+        conversation = self.conversations[root]
+        conversation['tweets'].append(tweet)
+        conversation['updated_at'] = max(conversation['updated_at'], tweet['created_at'])
+        if tweet['author_id'] in self.companies:
+            conversation['companies'].add(tweet['author_id'])
+        self.conversations.move_to_end(root)
+        # Replies that arrived before this Tweet were threaded into a conversation rooted at it, which now joins the
+        # conversation of its root
+        if root != tweet['tweet_id'] and tweet['tweet_id'] in self.conversations:
+            orphans = self.conversations.pop(tweet['tweet_id'])
+            self.set_trace(orphans, ())
+            for orphan in orphans['tweets']:
+                self.roots[orphan['tweet_id']] = root
+            conversation['tweets'] += orphans['tweets']
+            conversation['companies'] |= orphans['companies']
+            conversation['updated_at'] = max(conversation['updated_at'], orphans['updated_at'])
+        return root
+
+    def identify_languages(self, tweets):
+        languages = preprocessing.identify_languages([tweet['text'] for tweet in tweets])
+        for tweet, language in zip(tweets, languages):
+            tweet['english'] = language == '__label__en'
+
+    def correct_spellings(self, tweets):
+        # Same corrections as correct_spellings_inbound, but only for the opening Tweets that are classified
+        words = [tweet['text'].split() for tweet in tweets]
+        corrections = preprocessing.find_corrections(list(OrderedDict.fromkeys(word for tweet_words in words
+                                                                               for word in tweet_words)),
+                                                     self.spelling_cache)
+        for tweet, tweet_words in zip(tweets, words):
+            tweet['text'] = ' '.join(corrections.get(word, word) for word in tweet_words)
+
+    def classify(self, roots):
+        # Classifies the English Tweets not classified yet in the conversations whose company is known, the company
+        # Tweets with activities and the opening Tweets with topics. The other Tweets yield no events.
+        pending = {}
+        for root in roots:
+            conversation = self.conversations[root]
+            if len(conversation['companies']) != 1:
+                continue
+            company = next(iter(conversation['companies']))
+            for tweet in conversation['tweets']:
+                if tweet['names'] is not None or not tweet['english']:
+                    continue
+                if tweet['author_id'] == company:
+                    pending.setdefault((company, 0), []).append(tweet)
+                elif tweet['tweet_id'] == root:
+                    pending.setdefault((company, 1), []).append(tweet)
+                else:
+                    tweet['names'] = []
+        for (company, mappings_index), tweets in pending.items():
+            if mappings_index == 1:
+                self.correct_spellings(tweets)
+            texts = pd.Series([tweet['text'] for tweet in tweets])
+            with instrumentation.stage('streaming.classify', rows=len(tweets)):
+                names = classify_tweets(texts, self.mappings[company][mappings_index], self.nlp_cache,
+                                        self.batch_size)
+            for tweet, tweet_names in zip(tweets, names):
+                tweet['names'] = tweet_names
+
+    def trace(self, root):
+        # The activities and topics of a conversation that passes the filters of the preprocessing: a single company
+        # and more than one English Tweet. The Tweets are ordered by time like in the batch event logs.
+        conversation = self.conversations[root]
+        tweets = [tweet for tweet in conversation['tweets'] if tweet['english']]
+        if len(conversation['companies']) != 1 or len(tweets) < 2:
+            return None, []
+        tweets = sorted(tweets, key=lambda tweet: tweet['created_at'])
+        events = [(tweet, name) for tweet in tweets for name in tweet['names'] or []]
+        return next(iter(conversation['companies'])), events
+
+    def set_trace(self, conversation, trace, company=None):
+        # Replaces the contribution of the conversation to the directly-follows graph of its company
+        if conversation['trace'] == trace and conversation['company'] == company:
+            return
+        for sign, trace_company, activities in ((-1, conversation['company'], conversation['trace']),
+                                                (1, company, trace)):
+            if trace_company is None or len(activities) == 0:
+                continue
+            model = self.models[trace_company]
+            model['cases'] += sign
+            update_counts(model['activities'], Counter(activities), sign)
+            update_counts(model['start_activities'], {activities[0]: 1}, sign)
+            update_counts(model['end_activities'], {activities[-1]: 1}, sign)
+            update_counts(model['dfg'], Counter(zip(activities[:-1], activities[1:])), sign)
+        conversation['trace'] = trace
+        conversation['company'] = company
+
+    def close(self, root):
+        # Moves the events of the conversation to the ones to write to the event log of its company and forgets its
+        # Tweets
+        company, events = self.trace(root)
+        conversation = self.conversations.pop(root)
+        for tweet in conversation['tweets']:
+            self.roots.pop(tweet['tweet_id'], None)
+        self.closed += 1
+        if company is not None:
+            self.closed_events[company] += [[root, tweet['tweet_id'], tweet['created_at'].isoformat(),
+                                             tweet['author_id'], tweet['text'], company, name]
+                                            for tweet, name in events]
+
+    def write_events(self):
+        # Appends the events of the closed conversations to the event log of each company
+        for company, events in self.closed_events.items():
+            if len(events) == 0:
+                continue
+            df_events = pd.DataFrame(events, columns=event_columns)
+            df_events['text'] = unescape_twitter_entities(df_events['text'])
+            path = os.path.join(self.output_path, 'twcs-{}-stream.csv'.format(company))
+            with instrumentation.stage('streaming.write_events', rows=len(events)):
+                df_events.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+            self.events += len(events)
+            self.closed_events[company] = []
+
+    def close_idle(self):
+        # Closes the conversations without a Tweet for close_after, measured in the time of the Tweets, and the least
+        # recently updated ones beyond max_open. Late replies to a closed conversation start a new one.
+        cutoff = self.watermark - self.close_after
+        while len(self.conversations) > 0:
+            root, conversation = next(iter(self.conversations.items()))
+            if len(self.conversations) <= self.max_open and conversation['updated_at'] >= cutoff:
+                break
+            self.close(root)
+
+    def add(self, records):
+        tweets = parse_tweets(records, self.companies)
+        if len(tweets) == 0:
+            return
+        roots = OrderedDict((self.thread(tweet), None) for tweet in tweets)
+        self.identify_languages(tweets)
+        roots = [root for root in roots if root in self.conversations]
+        self.classify(roots)
+        self.nlp_cache.flush()
+        for root in roots:
+            company, events = self.trace(root)
+            self.set_trace(self.conversations[root], tuple(name for _, name in events), company)
+        latest = max(tweet['created_at'] for tweet in tweets)
+        self.watermark = latest if self.watermark is None else max(self.watermark, latest)
+        self.close_idle()
+        self.write_events()
+
+    def close_all(self):
+        while len(self.conversations) > 0:
+            self.close(next(iter(self.conversations)))
+        self.write_events()
+
+    def write_models(self):
+        # Snapshot of the directly-follows graph of each company, replaced atomically
+        for company, model in self.models.items():
+            path = os.path.join(self.output_path, 'twcs-{}-stream-dfg.json'.format(company))
+            snapshot = {
+                'cases': model['cases'],
+                'activities': dict(model['activities']),
+                'start_activities': dict(model['start_activities']),
+                'end_activities': dict(model['end_activities']),
+                'dfg': [[source, target, count] for (source, target), count in sorted(model['dfg'].items())],
+            }
+            with open(path + '.tmp', 'w') as stream:
+                json.dump(snapshot, stream, indent=1, sort_keys=True)
+            os.replace(path + '.tmp', path)
+
+
+def load_mappings(companies):
+    mappings_path = os.path.join('data', 'topics-activities')
+    mappings = {}
+    for company in companies:
+        df_activity_mappings = read_stage(find_stage_file(mappings_path, 'twcs-' + company + '-outbound-activities'))
+        df_topic_mappings = read_stage(find_stage_file(mappings_path, 'twcs-' + company + '-inbound-topics'))
+        mappings[company] = (compile_mappings(df_activity_mappings, 'Activity'),
+                             compile_mappings(df_topic_mappings, 'Topic'))
+    return mappings
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', nargs='?', default='-', help='JSONL or CSV file with Tweets, - for stdin.')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='Format of the source (default: jsonl for .jsonl files and stdin, csv otherwise).')
+    parser.add_argument('--follow', action='store_true', help='Keep waiting for Tweets appended to the source.')
+    parser.add_argument('--save-path', default=os.path.join('xes', 'stream'),
+                        help='Path where to save the event logs and directly-follows graphs.')
+    parser.add_argument('--batch-tweets', type=int, default=256, help='Maximum number of Tweets added at once.')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of Tweets and hypotheses per NLI batch.')
+    parser.add_argument('--close-after', type=float, default=24.0,
+                        help='Hours without a Tweet after which a conversation is closed and written.')
+    parser.add_argument('--max-open', type=int, default=100000, help='Maximum number of open conversations.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='Load the models in the background right away instead of on first use.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    if args.warm_start:
+        classifier.warm_start()
+        preprocessing.model.warm_start()
+        preprocessing.spell.warm_start()
+
+    companies = ['AmazonHelp', 'AppleSupport', 'SpotifyCares']
+
+    os.makedirs(args.save_path, exist_ok=True)
+
+    nlp_cache = open_nlp_cache()
+    spelling_cache = preprocessing.open_spelling_cache()
+    event_log = StreamingEventLog(companies, load_mappings(companies), nlp_cache, spelling_cache, args.save_path,
+                                  batch_size=args.batch_size, close_after=pd.Timedelta(hours=args.close_after),
+                                  max_open=args.max_open)
+
+    format = args.format or ('jsonl' if args.source == '-' or args.source.endswith('.jsonl') else 'csv')
+    stream = sys.stdin if args.source == '-' else open(args.source, newline='')
+    try:
+        for records in read_batches(read_records(follow_lines(stream, args.follow), format), args.batch_tweets):
+            with instrumentation.stage('streaming.add', rows=len(records)):
+                event_log.add(records)
+                event_log.write_models()
+    finally:
+        event_log.close_all()
+        event_log.write_models()
+        nlp_cache.close()
+        spelling_cache.close()
+        if stream is not sys.stdin:
+            stream.close()
@@ -0,0 +1,148 @@
+import argparse
+import csv
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Topics of the customers' opening Tweets and activities of the companies' replies, each with the phrases that
+# express it, the keyword the keyword classification searches for, and the NLI hypothesis
+topics = {
+    'Delivery': (['my package was not delivered', 'the delivery is late again', 'where is my order'],
+                 'deliver', 'The example is about delivery'),
+    'Refund': (['i want a refund for this', 'still waiting for my refund', 'how do i get my money back'],
+               'refund', 'The example is about a refund'),
+    'Account': (['i cannot log into my account', 'my account got locked', 'someone hacked my account'],
+                'account', 'The example is about an account'),
+    'App': (['the app keeps crashing', 'the app is so slow today', 'the latest update broke the app'],
+            'app', 'The example is about the app'),
+    'Battery': (['my battery drains really fast', 'battery life is terrible since the update',
+                 'the phone shuts down at 30 percent battery'], 'battery', 'The example is about the battery'),
+}
+
+activities = {
+    'Apologize': (['sorry to hear about this', 'we apologize for the trouble'], 'sorry',
+                  'The example is an apology'),
+    'Request DM': (['please send us a DM with more details', 'can you DM us your email address'], 'dm',
+                   'The example asks for a DM'),
+    'Provide URL': (['more information is available here https://t.co/{}', 'check out https://t.co/{}'],
+                    'https://t.co', 'The example provides a https://t.co'),
+    'Request restart': (['does restarting your device help', 'please try to restart the app'], 'restart',
+                        'The example asks to restart'),
+}
+
+follow_ups = ['thanks for the quick reply', 'that did not help at all', 'ok i sent you a message', 'still not working',
+              'it works now thank you']
+
+# Words that the spelling correction has to fix
+misspellings = {'package': 'pakage', 'delivered': 'deliverd', 'account': 'acount', 'really': 'realy',
+                'update': 'updat', 'waiting': 'wating'}
+
+default_company_mix = 'AmazonHelp=0.5,AppleSupport=0.3,SpotifyCares=0.2'
+
+non_english_texts = ['mi pedido no ha llegado todavía', 'mein Paket ist immer noch nicht angekommen',
+                     'je voudrais un remboursement', 'la aplicación no funciona', 'das Konto ist gesperrt',
+                     'merci pour votre aide']
+
+
+def misspell(text, rng, rate):
+    return ' '.join(misspellings[word] if word in misspellings and rng.random() < rate else word
+                    for word in text.split())
+
+
+def parse_company_mix(value):
+    # E.g. AmazonHelp=0.5,AppleSupport=0.3,SpotifyCares=0.2
+    return {company: float(share) for company, share in (item.split('=') for item in value.split(','))}
+
+
+def generate_conversations(conversations=1000, max_depth=6, companies=None, non_english=0.1, misspelling=0.2,
+                           seed=0):
+    # Tweets in the format of twcs.csv: each conversation opens with a customer Tweet, which the company and the
+    # customer answer in turns up to max_depth replies. companies maps each company to its share of the
+    # conversations, non_english is the share of Tweets in another language.
+    rng = np.random.default_rng(seed)
+    if companies is None:
+        companies = parse_company_mix(default_company_mix)
+    company_names = list(companies)
+    shares = np.array([companies[company] for company in company_names], dtype=np.float64)
+    topic_names = list(topics)
+    activity_names = list(activities)
+    start = pd.Timestamp('2017-10-01', tz='UTC').value
+    rows = []
+    tweet_id = 1
+    for conversation in range(conversations):
+        company = company_names[rng.choice(len(company_names), p=shares / shares.sum())]
+        customer = str(100000 + conversation)
+        created_at = start + int(rng.integers(0, 60 * 24 * 3600)) * 10 ** 9
+        depth = int(rng.integers(1, max_depth + 1))
+        parent_id = None
+        for reply in range(depth + 1):
+            inbound = reply % 2 == 0
+            if rng.random() < non_english:
+                text = non_english_texts[rng.integers(len(non_english_texts))]
+            elif reply == 0:
+                phrases = topics[topic_names[rng.integers(len(topic_names))]][0]
+                text = misspell('@{} {}'.format(company, phrases[rng.integers(len(phrases))]), rng, misspelling)
+            elif inbound:
+                text = misspell('@{} {}'.format(company, follow_ups[rng.integers(len(follow_ups))]), rng, misspelling)
+            else:
+                names = rng.choice(activity_names, size=int(rng.integers(1, 3)), replace=False)
+                text = '@{} '.format(customer) + ' '.join(
+                    activities[name][0][rng.integers(len(activities[name][0]))].format(tweet_id) for name in names)
+            rows.append({
+                'tweet_id': tweet_id,
+                'author_id': customer if inbound else company,
+                'inbound': inbound,
+                'created_at': created_at,
+                'text': text,
+                'response_tweet_id': str(tweet_id + 1) if reply < depth else np.nan,
+                'in_response_to_tweet_id': float(parent_id) if parent_id is not None else np.nan,
+            })
+            parent_id = tweet_id
+            tweet_id += 1
+            created_at += int(rng.integers(1, 180)) * 60 * 10 ** 9
+    df = pd.DataFrame(rows)
+    df['created_at'] = pd.to_datetime(df['created_at'], utc=True).dt.strftime('%a %b %d %H:%M:%S %z %Y')
+    # The Tweets of twcs.csv are not grouped by conversation
+    return df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def nli_template(names):
+    # One column of hypotheses per topic or activity, like the files in data/nli-templates
+    return pd.DataFrame({name: [names[name][2]] for name in names})
+
+
+def mappings(names, name_column, threshold=0.9):
+    # Topic or activity mappings like the files in data/topics-activities
+    return pd.DataFrame({name_column: list(names), 'Label': [names[name][2] for name in names],
+                         'Optimal Threshold': threshold, 'Keyword': [names[name][1] for name in names]})
+
+
+def label(texts, names):
+    # Labels each text with the topics or activities whose keyword it contains, in place of manual labels
+    return pd.DataFrame({name: texts.str.lower().str.contains(names[name][1], regex=False).astype(np.int64)
+                         for name in names}, index=texts.index)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--conversations', type=int, default=10000, help='Number of conversations.')
+    parser.add_argument('--max-depth', type=int, default=6, help='Maximum number of replies per conversation.')
+    parser.add_argument('--companies', type=parse_company_mix, default=default_company_mix,
+                        help='Share of the conversations of each company, e.g. {}.'.format(default_company_mix))
+    parser.add_argument('--non-english', type=float, default=0.1, help='Share of Tweets in another language.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='twcs-synthetic.csv', help='CSV file to write the Tweets to.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrumentation.start_from_arguments(args)
+
+    with instrumentation.stage('synthetic_twcs.generate_conversations') as timer:
+        df = generate_conversations(args.conversations, args.max_depth, args.companies, args.non_english,
+                                    seed=args.seed)
+        timer.rows = len(df.index)
+    with instrumentation.stage('synthetic_twcs.write_csv', rows=len(df.index)):
+        df.to_csv(args.output, index=False, quoting=csv.QUOTE_ALL)
@@ -0,0 +1,107 @@
+from collections import Counter
+
+import numpy as np
+
+
+def directly_follows(variants, window=1):
+    # variants maps each variant, a tuple of activities, to its number of cases
+    dfg = Counter()
+    for variant, count in variants.items():
+        for i in range(window, len(variant)):
+            dfg[(variant[i - window], variant[i])] += count
+    return dfg
+
+
+def frequency_triples(variants):
+    triples = Counter()
+    for variant, count in variants.items():
+        for i in range(2, len(variant)):
+            triples[(variant[i - 2], variant[i - 1], variant[i])] += count
+    return triples
+
+
+def count_activities(variants):
+    activities = {}
+    for variant, count in variants.items():
+        for activity in variant:
+            activities[activity] = activities.get(activity, 0) + count
+    return activities
+
+
+def count_endpoints(variants, position):
+    # Start activities for position 0, end activities for position -1
+    endpoints = {}
+    for variant, count in variants.items():
+        if len(variant) > 0:
+            endpoints[variant[position]] = endpoints.get(variant[position], 0) + count
+    return endpoints
+
+
+class VariantIndex:
+
+    def __init__(self, variants):
+        # variants maps each variant to the IDs of its cases, both in the order they appear in the log. The statistics
+        # are derived from the variants and their counts only, weighting each variant by its number of cases.
+        self.variants = variants
+        self.counts = {variant: len(cases) for variant, cases in variants.items()}
+        self.dfg = directly_follows(self.counts)
+        self.activities = count_activities(self.counts)
+        self.start_activities = count_endpoints(self.counts, 0)
+        self.end_activities = count_endpoints(self.counts, -1)
+
+    @classmethod
+    def from_events(cls, events):
+        codes = events['case:concept:name'].cat.codes.values
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        activities = np.asarray(events['concept:name'].values, dtype=object)[order]
+        case_ids = events['case:concept:name'].cat.categories
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) > 0 else []
+        variants = {}
+        for start, end in zip(starts, list(starts[1:]) + [len(codes)]):
+            variants.setdefault(tuple(activities[start:end]), []).append(case_ids[codes[start]])
+        return cls(variants)
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def select(self, variants):
+        return VariantIndex({variant: self.variants[variant] for variant in variants})
+
+    def sorted_by_count(self):
+        # Same order as PM4Py's variant statistics, descending by count and then by the comma separated variant
+        return sorted(self.counts, key=lambda variant: (self.counts[variant], ','.join(variant)), reverse=True)
+
+    def top_k(self, k):
+        top_variants = set(self.sorted_by_count()[:k])
+        return self.select([variant for variant in self.variants if variant in top_variants])
+
+    def percentage(self, percentage):
+        # Adds the most frequent variants until they cover the percentage of cases, together with the variants that
+        # are as frequent as the last one added, like PM4Py's variants percentage filter
+        selected = []
+        total = len(self)
+        added = 0
+        break_under = -1
+        for variant in self.sorted_by_count():
+            if self.counts[variant] < break_under:
+                break
+            selected.append(variant)
+            added += self.counts[variant]
+            if added / total >= percentage:
+                break_under = self.counts[variant]
+        return self.select(selected)
+
+    def auto_percentage(self, decreasing_factor):
+        # Covered percentage when adding variants until one is less frequent than decreasing_factor times the previous
+        added = 0
+        previous_count = -1
+        for variant in self.sorted_by_count():
+            if added > 0 and self.counts[variant] <= decreasing_factor * previous_count:
+                break
+            added += self.counts[variant]
+            previous_count = self.counts[variant]
+        return added / len(self) if len(self) > 0 else 0
+
+    def auto(self, decreasing_factor):
+        return self.percentage(self.auto_percentage(decreasing_factor))
@@ -0,0 +1,191 @@
+import gzip
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lxml import etree
+
+from stage_io import file_digest
+
+extensions = [
+    ('Concept', 'concept', 'http://www.xes-standard.org/concept.xesext'),
+    ('Time', 'time', 'http://www.xes-standard.org/time.xesext'),
+    ('Organizational', 'org', 'http://www.xes-standard.org/org.xesext'),
+]
+
+value_types = {
+    'str': 'string',
+    'int': 'int',
+    'float': 'float',
+    'bool': 'boolean',
+    'datetime': 'date',
+    'Timestamp': 'date',
+}
+
+
+def escape_xml(values):
+    return (values.str.replace('&', '&amp;', regex=False)
+            .str.replace('<', '&lt;', regex=False)
+            .str.replace('>', '&gt;', regex=False)
+            .str.replace('"', '&quot;', regex=False))
+
+
+def format_values(values):
+    # Types and values as pm4py's line-by-line exporter writes them for the rows of a DataFrame
+    if pd.api.types.is_bool_dtype(values):
+        return 'boolean', values.map({True: 'true', False: 'false'})
+    if pd.api.types.is_integer_dtype(values):
+        return 'int', values.astype(str)
+    if pd.api.types.is_float_dtype(values):
+        return 'float', values.map(str)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return 'date', values.map(lambda value: value.isoformat())
+    types = values.map(lambda value: value_types.get(type(value).__name__, 'string'))
+    formatted = values.map(lambda value: value.isoformat() if type(value).__name__ in ('datetime', 'Timestamp')
+                           else str(value).lower() if isinstance(value, (bool, np.bool_)) else str(value))
+    return types, formatted
+
+
+def format_attributes(values, key, indent):
+    types, formatted = format_values(values)
+    return indent + '<' + types + ' key="' + key + '" value="' + escape_xml(formatted) + '" />\n'
+
+
+def write_xes(df_event_log, path, case_column='case:concept:name', compress=None, chunk_size=10000):
+    # Streams the events trace by trace from the DataFrame, formatting about chunk_size events at a time. The traces
+    # are ordered by the first appearance of their case, the events within a trace keep their order.
+    if compress is None:
+        compress = path.endswith('.gz')
+    codes, _ = pd.factorize(df_event_log[case_column])
+    df_event_log = df_event_log.iloc[np.argsort(codes, kind='stable')].reset_index(drop=True)
+    cases = df_event_log[case_column].values
+    # An empty event log has no traces, only the header
+    starts = np.flatnonzero(np.r_[True, cases[1:] != cases[:-1]]) if len(cases) > 0 else np.array([], dtype=np.int64)
+    attributes = [column for column in df_event_log.columns if column != case_column]
+    with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as stream:
+        stream.write('<?xml version="1.0" encoding="utf-8" ?>\n<log>\n'.encode('utf-8'))
+        for name, prefix, uri in extensions:
+            stream.write('\t<extension name="{}" prefix="{}" uri="{}" />\n'.format(name, prefix, uri).encode('utf-8'))
+        stream.write('\t<string key="origin" value="csv" />\n'.encode('utf-8'))
+        boundaries = list(starts[::max(1, len(starts) * chunk_size // max(len(cases), 1))]) + [len(cases)]
+        for begin, end in zip(boundaries[:-1], boundaries[1:]):
+            df_chunk = df_event_log.iloc[begin:end]
+            chunk_cases = cases[begin:end]
+            first = np.r_[True, chunk_cases[1:] != chunk_cases[:-1]]
+            last = np.r_[chunk_cases[1:] != chunk_cases[:-1], True]
+            events = '\t\t<event>\n'
+            for column in attributes:
+                events = events + format_attributes(df_chunk[column], column, '\t\t\t')
+            events = events + '\t\t</event>\n'
+            trace_starts = '\t<trace>\n' + format_attributes(df_chunk[case_column], 'concept:name', '\t\t')
+            lines = (trace_starts.where(first, '') + events + pd.Series(np.where(last, '\t</trace>\n', ''),
+                                                                         index=df_chunk.index))
+            stream.write(''.join(lines.values).encode('utf-8'))
+        stream.write('</log>\n'.encode('utf-8'))
+
+
+def open_xes(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def parse_value(attribute):
+    if attribute is None:
+        return None
+    tag = attribute.tag.rsplit('}', 1)[-1]
+    value = attribute.get('value')
+    if tag == 'int':
+        return int(value)
+    if tag == 'float':
+        return float(value)
+    if tag == 'boolean':
+        return value.lower() == 'true'
+    return value
+
+
+def to_categorical(values):
+    # Integer codes in order of first appearance, -1 for missing values
+    if isinstance(values, pd.Series) and pd.api.types.is_categorical_dtype(values):
+        return values
+    codes, categories = pd.factorize(pd.Series(values))
+    return pd.Categorical.from_codes(codes, categories)
+
+
+def import_xes(path):
+    # Parses the XES file incrementally into an event table with one row per event in file order. Cases, activities
+    # and resources are categorical, i.e. integer codes into their distinct values, and timestamps are datetime64.
+    # Traces with the same name form one case, as in PM4Py's conversions between event streams and logs.
+    cases, activities, resources, timestamps = [], [], [], []
+    trace_events = []
+    with open_xes(path) as stream:
+        for _, element in etree.iterparse(stream, events=('end',), tag=('{*}event', '{*}trace')):
+            if element.tag.rsplit('}', 1)[-1] == 'event':
+                attributes = {attribute.get('key'): attribute for attribute in element}
+                trace_events.append((parse_value(attributes.get('concept:name')),
+                                     parse_value(attributes.get('org:resource')),
+                                     parse_value(attributes.get('time:timestamp'))))
+                continue
+            case = None
+            for attribute in element:
+                if attribute.get('key') == 'concept:name':
+                    case = parse_value(attribute)
+            for activity, resource, timestamp in trace_events:
+                cases.append(case)
+                activities.append(activity)
+                resources.append(resource)
+                timestamps.append(timestamp)
+            trace_events = []
+            # Drops the parsed trace and its predecessors, so memory does not grow with the size of the file
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    return pd.DataFrame({
+        'case:concept:name': to_categorical(cases),
+        'concept:name': to_categorical([None if value is None else str(value) for value in activities]),
+        'org:resource': to_categorical([None if value is None else str(value) for value in resources]),
+        'time:timestamp': pd.to_datetime(pd.Series(timestamps, dtype=object)),
+    })
+
+
+def write_event_table(table, path, source):
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    metadata = dict(arrow_table.schema.metadata or {})
+    metadata[b'xes_source'] = json.dumps(source).encode('utf-8')
+    pq.write_table(arrow_table.replace_schema_metadata(metadata), path)
+
+
+def read_event_table(path):
+    # Parquet restores dictionary encoded strings as categoricals but integer case names as plain integers
+    table = pq.read_table(path).to_pandas()
+    for column in ('case:concept:name', 'concept:name', 'org:resource'):
+        table[column] = to_categorical(table[column])
+    return table
+
+
+def read_event_table_source(path):
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[b'xes_source']) if b'xes_source' in metadata else None
+
+
+def load_xes(path, cache_path=None, use_cache=True):
+    # The event table is cached beside the XES file and reused as long as the file keeps its size and modification
+    # time, or its content hash if only the modification time changed
+    if cache_path is None:
+        cache_path = path + '.parquet'
+    stat = os.stat(path)
+    if use_cache and os.path.exists(cache_path):
+        cached = read_event_table_source(cache_path)
+        if cached is not None and cached['size'] == stat.st_size:
+            if cached['mtime_ns'] == stat.st_mtime_ns:
+                return read_event_table(cache_path)
+            if cached['digest'] == file_digest(path):
+                table = read_event_table(cache_path)
+                write_event_table(table, cache_path, dict(cached, mtime_ns=stat.st_mtime_ns))
+                return table
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': file_digest(path)}
+    table = import_xes(path)
+    if use_cache:
+        write_event_table(table, cache_path, source)
+    return table